@@ -0,0 +1,57 @@
+"""
+Compares reviews.profanity with the substring search it replaced, for a
+random word list and a review text without profanities:
+
+    python benchmarks/bench_profanity.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from reviews.profanity import ProfanityMatcher, get_matcher
+
+def benchmark(word_count=5000, text_length=3000, repeat=200):
+    """
+    Prints the time per text of each search and the time to compile the
+    matcher.
+    """
+    random.seed(0)
+    letters = u'abcdefghijklmnopqrstuvwxyz\xe4\xf6\xfc\xdf'
+    def random_word(length):
+        return u''.join([random.choice(letters) for i in range(length)])
+
+    words = list(set([random_word(random.randint(4, 10)) for i in range(word_count)]))
+    text = []
+    while len(u' '.join(text)) < text_length:
+        text.append(random_word(random.randint(2, 3)))
+    text = u' '.join(text)[:text_length]
+
+    def substring_search():
+        lower = text.lower()
+        return [w for w in words if w in lower]
+
+    def matcher_search():
+        return get_matcher(words).find_all(text)
+
+    def boundary_search():
+        return get_matcher(words, word_boundaries=True).find_all(text)
+
+    assert substring_search() == matcher_search() == []
+    start = timeit.default_timer()
+    ProfanityMatcher(words)
+    build = timeit.default_timer() - start
+
+    print "%d words, text of %d characters, %d runs" % (len(words), len(text), repeat)
+    print "compiling the matcher:  %8.2f ms (once per word list)" % (build * 1000)
+    for name, function in (('substring search', substring_search),
+                           ('matcher', matcher_search),
+                           ('matcher, whole words', boundary_search)):
+        function()
+        seconds = min(timeit.repeat(function, number=repeat, repeat=3)) / repeat
+        print "%-22s %8.3f ms per text" % (name + ':', seconds * 1000)
+
+if __name__ == '__main__':
+    benchmark()
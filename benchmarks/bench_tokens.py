@@ -0,0 +1,52 @@
+"""
+Compares reviews.tokens with reviews.signing for a category code: signing,
+verifying, and the "is it signed already" check of the review form. Uses the
+settings of the test project:
+
+    python benchmarks/bench_tokens.py
+"""
+import os
+import sys
+import timeit
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, PROJECT_PATH)
+sys.path.insert(0, os.path.join(PROJECT_PATH, 'testapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from reviews import signing, tokens
+
+def benchmark(repeat=20000):
+    """
+    Prints the time per call of both codecs.
+    """
+    value = 'sports-cars'
+    signed = signing.dumps(value)
+    token = tokens.dumps(value)
+
+    def signing_is_signed():
+        try:
+            signing.loads(value)
+            return True
+        except signing.BadSignature:
+            return False
+
+    def verify_uncached():
+        tokens._verified.clear()
+        return tokens.loads(token)
+
+    print "token: %s (%d characters)" % (token, len(token))
+    print "signing: %s (%d characters)" % (signed, len(signed))
+    for name, function in (
+            ('signing.dumps', lambda: signing.dumps(value)),
+            ('tokens.dumps', lambda: tokens.dumps(value)),
+            ('signing.loads', lambda: signing.loads(signed)),
+            ('tokens.loads (uncached)', verify_uncached),
+            ('tokens.loads (cached)', lambda: tokens.loads(token)),
+            ('signing "is signed"', signing_is_signed),
+            ('tokens.is_signed', lambda: tokens.is_signed(value))):
+        seconds = min(timeit.repeat(function, number=repeat, repeat=3)) / repeat
+        print "%-24s %8.2f us" % (name + ':', seconds * 1000000)
+
+if __name__ == '__main__':
+    benchmark()
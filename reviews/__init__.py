@@ -1,12 +1,14 @@
 from django.conf import settings
 from django.core import urlresolvers
 from django.core.exceptions import ImproperlyConfigured
-from reviews.models import Review
-from forms import ReviewForm
 from django.utils.importlib import import_module
 
 DEFAULT_REVIEWS_APP = 'reviews'
 
+# the hooks of the REVIEWS_APP by name, None for hooks the app doesn't define.
+# Filled on first use, see get_review_app_hook().
+_hooks = {}
+
 def get_review_app():
     """
     Get the reviews app (i.e. "reviews") as defined in the settings
@@ -33,48 +35,72 @@ def get_review_app_name():
     """
     return getattr(settings, 'REVIEWS_APP', DEFAULT_REVIEWS_APP)
 
+def get_review_app_hook(name):
+    """
+    Returns the function ``name`` of the custom review app, or None if the
+    default app is used or the custom app doesn't define it. The review app is
+    only imported and searched once per hook.
+    """
+    try:
+        return _hooks[name]
+    except KeyError:
+        hook = None
+        if get_review_app_name() != DEFAULT_REVIEWS_APP:
+            hook = getattr(get_review_app(), name, None)
+        _hooks[name] = hook
+        return hook
+
 def get_model():
     """
     Returns the review model class.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_model"):
-        return get_review_app().get_model()
+    hook = get_review_app_hook("get_model")
+    if hook is not None:
+        return hook()
     else:
+        from reviews.models import Review
         return Review
 
 def get_segment_model():
     """
-    Returns the review model class.
+    Returns the review segment model class.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_segment_model"):
-        return get_review_app().get_segment_model()
+    hook = get_review_app_hook("get_segment_model")
+    if hook is not None:
+        return hook()
     else:
+        from reviews.models import ReviewSegment
         return ReviewSegment
 
 def get_form():
     """
     Returns the review ModelForm class.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_form"):
-        return get_review_app().get_form()
+    hook = get_review_app_hook("get_form")
+    if hook is not None:
+        return hook()
     else:
+        from reviews.forms import ReviewForm
         return ReviewForm
 
 def get_segment_form():
     """
-    Returns the review ModelForm class.
+    Returns the review segment form class.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_segment_form"):
-        return get_review_app().get_segment_form()
+    hook = get_review_app_hook("get_segment_form")
+    if hook is not None:
+        return hook()
     else:
+        from reviews.forms import ReviewSegmentForm
         return ReviewSegmentForm
 
 def get_form_target():
     """
     Returns the target URL for the review form submission view.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_form_target"):
-        return get_review_app().get_form_target()
+    hook = get_review_app_hook("get_form_target")
+    if hook is not None:
+        return hook()
     else:
         return urlresolvers.reverse("reviews-post-review")
         #return urlresolvers.reverse("reviews.views.reviews.post_review")
@@ -83,8 +109,9 @@ def get_flag_url(review):
     """
     Get the URL for the "flag this review" view.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_flag_url"):
-        return get_review_app().get_flag_url(review)
+    hook = get_review_app_hook("get_flag_url")
+    if hook is not None:
+        return hook(review)
     else:
         return urlresolvers.reverse("reviews.views.moderation.flag",
                                     args=(review.id,))
@@ -93,8 +120,9 @@ def get_delete_url(review):
     """
     Get the URL for the "delete this review" view.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_delete_url"):
-        return get_review_app().get_delete_url(review)
+    hook = get_review_app_hook("get_delete_url")
+    if hook is not None:
+        return hook(review)
     else:
         return urlresolvers.reverse("reviews.views.moderation.delete",
                                     args=(review.id,))
@@ -103,8 +131,9 @@ def get_approve_url(review):
     """
     Get the URL for the "approve this review from moderation" view.
     """
-    if get_review_app_name() != DEFAULT_REVIEWS_APP and hasattr(get_review_app(), "get_approve_url"):
-        return get_review_app().get_approve_url(review)
+    hook = get_review_app_hook("get_approve_url")
+    if hook is not None:
+        return hook(review)
     else:
         return urlresolvers.reverse("reviews.views.moderation.approve",
                                     args=(review.id,))
@@ -1,7 +1,18 @@
+from django.conf import settings
 from django.core import urlresolvers
-from django.utils.translation import ugettext as _
+from django.core.paginator import InvalidPage, Paginator
+from django.utils.html import escape, linebreaks
+from django.utils.translation import ugettext as _, ungettext
 from django.contrib import admin
-from reviews.models import Review, ReviewSegment, Category, CategorySegment
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, MAX_SHOW_ALL_ALLOWED
+from reviews.models import Review, ReviewSegment, Category, CategorySegment, \
+    ArchivedReview, SpooledReview
+from reviews.pagination import attach_content_objects, EstimatedCountPaginator
+
+# estimate the review count of unfiltered changelists from the database
+# statistics instead of counting all rows, see EstimatedCountPaginator
+REVIEWS_ADMIN_ESTIMATED_COUNT = getattr(settings, 'REVIEWS_ADMIN_ESTIMATED_COUNT', False)
 
 class ReviewSegmentInline(admin.TabularInline):
     model = ReviewSegment
@@ -19,8 +30,65 @@ class ReviewSegmentInline(admin.TabularInline):
     changing of the existing segments is also not allowed """
     readonly_fields = ('segment',)
 
+class ReviewChangeList(ChangeList):
+    """
+    Changelist for large review tables: users and categories are joined into
+    the review query, and the reviewed objects of a page are loaded with one
+    query per content type instead of one per row.
+
+    The total count is taken from the paginator of the admin as well, so with
+    EstimatedCountPaginator neither count of a changelist scans the table.
+    """
+
+    def get_query_set(self, *args, **kwargs):
+        qs = super(ReviewChangeList, self).get_query_set(*args, **kwargs)
+        return qs.select_related('user', 'category')
+
+    def get_results(self, request):
+        # ChangeList.get_results(), except for the total count
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = self.model_admin.get_paginator(
+                request, self.root_query_set, self.list_per_page).count
+
+        can_show_all = result_count <= MAX_SHOW_ALL_ALLOWED
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num+1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        # loads the page; the queryset keeps the instances
+        attach_content_objects(result_list)
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
 class ReviewAdmin(admin.ModelAdmin):
-    list_display = ('__unicode__', 'content_object')
+    list_display = ('__unicode__', 'content_object', 'user', 'category', 'rating',
+                    'submit_date', 'is_public', 'is_removed', 'removal_suggestions')
+
+    # the filters and the date hierarchy are served by the review indexes:
+    # (is_public, is_removed, submit_date), category and submit_date
+    list_filter = ('is_public', 'is_removed', 'category')
+    date_hierarchy = 'submit_date'
+    ordering = ('-submit_date',)
+
+    if REVIEWS_ADMIN_ESTIMATED_COUNT:
+        paginator = EstimatedCountPaginator
+    else:
+        paginator = Paginator
 
     raw_id_fields = ('user',)
 
@@ -28,6 +96,23 @@ class ReviewAdmin(admin.ModelAdmin):
         ReviewSegmentInline,
     ]
 
+    actions = ['approve_reviews', 'remove_reviews']
+
+    def approve_reviews(self, request, queryset):
+        approved = Review.objects.approve(queryset, request.user, request)
+        self.message_user(request, ungettext("%d review was approved.",
+            "%d reviews were approved.", approved) % approved)
+    approve_reviews.short_description = _('Approve selected reviews')
+
+    def remove_reviews(self, request, queryset):
+        removed = Review.objects.remove(queryset, request.user, request)
+        self.message_user(request, ungettext("%d review was removed.",
+            "%d reviews were removed.", removed) % removed)
+    remove_reviews.short_description = _('Remove selected reviews')
+
+    def get_changelist(self, request, **kwargs):
+        return ReviewChangeList
+
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('code', 'segment_link')
 
@@ -48,6 +133,75 @@ class CategorySegmentAdmin(admin.ModelAdmin):
 
     search_fields = ['title', 'category__code']
 
+class ArchivedReviewAdmin(admin.ModelAdmin):
+    """
+    Read-only access to the archived reviews. The compressed record is shown
+    as if it was a normal review; "restore" moves reviews back.
+    """
+    list_display = ('review_id', 'title', 'user_name', 'content_type', 'object_pk',
+                    'category', 'rating', 'submit_date', 'is_removed', 'archive_date')
+    list_filter = ('category', 'is_removed', 'is_public')
+    list_select_related = True
+    date_hierarchy = 'archive_date'
+    search_fields = ['=review_id', '=object_pk']
+
+    fields = ('review_id', 'content_type', 'object_pk', 'site', 'category',
+              'user_name', 'user_email', 'title', 'text', 'rating', 'segments',
+              'submit_date', 'is_public', 'is_removed', 'archive_date')
+    readonly_fields = fields
+
+    actions = ['restore_reviews']
+
+    def has_add_permission(self, request):
+        return False
+
+    def user_name(self, obj):
+        return obj.record.get('user_name')
+    user_name.short_description = _("user's name")
+
+    def user_email(self, obj):
+        return obj.record.get('user_email')
+    user_email.short_description = _("user's email address")
+
+    def title(self, obj):
+        return obj.record.get('title')
+    title.short_description = _('title')
+
+    def text(self, obj):
+        return linebreaks(escape(obj.record.get('text')))
+    text.short_description = _('review')
+    text.allow_tags = True
+
+    def segments(self, obj):
+        return ''.join(['<p><b>%s</b> (%s)<br>%s</p>' % (
+            escape(segment['segment']), escape(segment['rating']),
+            escape(segment.get('text') or '')) for segment in obj.record['segments']])
+    segments.short_description = _('segments')
+    segments.allow_tags = True
+
+    def restore_reviews(self, request, queryset):
+        restored, taken = ArchivedReview.objects.restore(queryset)
+        self.message_user(request, ungettext("%d review was restored.",
+            "%d reviews were restored.", restored) % restored)
+        if taken:
+            self.message_user(request, _("The ids of the archived reviews %s belong "
+                "to other reviews now; they were not restored.") %
+                ", ".join([str(pk) for pk in taken]))
+    restore_reviews.short_description = _('Restore selected reviews')
+
+class SpooledReviewAdmin(admin.ModelAdmin):
+    """
+    Shows the review submissions waiting for process_review_spool, with the
+    error of failed ones.
+    """
+    list_display = ('__unicode__', 'spool_date', 'attempts', 'last_error')
+    readonly_fields = ('idempotency_key', 'spool_date', 'attempts', 'last_error', 'data')
+
+    def has_add_permission(self, request):
+        return False
+
 admin.site.register(Review, ReviewAdmin)
+admin.site.register(ArchivedReview, ArchivedReviewAdmin)
+admin.site.register(SpooledReview, SpooledReviewAdmin)
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(CategorySegment, CategorySegmentAdmin)
@@ -0,0 +1,148 @@
+"""
+Helpers to write many review rows with few statements.
+
+The rows are inserted as they are: the save() methods of the models are not
+called, so the review summaries are not maintained and object_id is not filled
+by these functions. Callers prepare the instances and update the summaries for
+the whole batch afterwards. save_review() is the exception: it writes one new
+review with its segments, summaries included.
+"""
+import threading
+from django.db import connections, router, transaction
+from django.db.models import AutoField
+
+_state = threading.local()
+
+class suspend_summaries(object):
+    """
+    Context manager that stops save() and the delete signal handlers from
+    updating the review summaries one row at a time. Use it around bulk
+    changes and call update_summaries()/rebuild_summaries() for the batch.
+    """
+
+    def __enter__(self):
+        self.previous = summaries_suspended()
+        _state.summaries_suspended = True
+        return self
+
+    def __exit__(self, *exc_info):
+        _state.summaries_suspended = self.previous
+        return False
+
+def summaries_suspended():
+    return getattr(_state, 'summaries_suspended', False)
+
+def can_return_pks(model, using=None):
+    """
+    Whether bulk_insert() can set the primary keys of inserted ``model``
+    instances without inserting them one by one.
+    """
+    using = using or router.db_for_write(model)
+    return hasattr(model._default_manager, 'bulk_create') and \
+        not model._meta.parents and \
+        getattr(connections[using].features, 'can_return_ids_from_bulk_insert', False)
+
+def bulk_insert(objs, using=None, set_pks=False):
+    """
+    Inserts unsaved instances of one model.
+
+    Uses bulk_create() where Django provides it, otherwise one executemany()
+    for all rows. Models with multi-table inheritance need a row per parent
+    table and are inserted one by one. If ``set_pks`` is True the instances
+    need their primary keys afterwards; if the database can't return them
+    from a multi-row insert, the rows are inserted one by one as well.
+    """
+    if not objs:
+        return objs
+    model = objs[0].__class__
+    using = using or router.db_for_write(model)
+
+    if model._meta.parents or (set_pks and not can_return_pks(model, using)):
+        for obj in objs:
+            obj.save_base(force_insert=True, using=using)
+        return objs
+
+    # save() fills object_id with the pre_save signal, which isn't sent here
+    from reviews.models import fill_object_id
+    for obj in objs:
+        fill_object_id(model, obj)
+
+    manager = model._default_manager.db_manager(using)
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create(objs)
+        return objs
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join(["%s"] * len(fields)),
+    )
+    params = [[f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+               for f in fields] for obj in objs]
+    connection.cursor().executemany(sql, params)
+    transaction.set_dirty(using=using)
+    return objs
+
+def save_review(review, segments, using=None):
+    """
+    Saves a new review and its segments in one transaction: the review with
+    save(), the segments with one bulk_insert(). The summaries are updated
+    once for the review and all its segments afterwards. Like all bulk
+    inserted rows, the segment instances may not get their primary keys;
+    reload them from the review to change them later.
+
+    Used by the post_review view; custom review forms, admin code etc. should
+    use it as well instead of saving the segments one by one.
+    """
+    from reviews.fragments import bump_object_version
+    from reviews.models import ReviewSummary, SegmentSummary
+
+    using = using or router.db_for_write(review.__class__, instance=review)
+    with transaction.commit_on_success(using=using):
+        old_state = review._summary_state
+        with suspend_summaries():
+            review.save(using=using)
+            for segment in segments:
+                segment.review = review
+            bulk_insert(segments, using=using)
+
+        if not summaries_suspended():
+            new_state = review.get_summary_state()
+            ReviewSummary.objects.update_for_review(old_state, new_state)
+            SegmentSummary.objects.update_for_review(review, old_state, new_state)
+            review._summary_state = new_state
+            bump_object_version(review.content_type_id, review.object_pk)
+    return review
+
+def update_summaries(reviews):
+    """
+    Rebuilds the review and segment summaries of all objects the given
+    (bulk inserted or updated) reviews belong to, once per object.
+    """
+    keys = []
+    for review in reviews:
+        state = review.get_summary_state()
+        review._summary_state = state
+        keys.append((state['content_type_id'], state['object_pk'],
+                     state['site_id'], state['category_id']))
+    rebuild_summaries(keys)
+
+def rebuild_summaries(keys):
+    """
+    Rebuilds the review summaries of the given (content_type_id, object_pk,
+    site_id, category_id) keys and the segment summaries of their objects,
+    and invalidates the cached review lists of the objects.
+    """
+    from reviews.fragments import bump_object_version
+    from reviews.models import ReviewSummary, SegmentSummary
+
+    keys = set([(ct, unicode(pk), site, category) for ct, pk, site, category in keys])
+    for key in keys:
+        ReviewSummary.objects.rebuild(key)
+    for object_key in set([key[:3] for key in keys]):
+        SegmentSummary.objects.rebuild(object_key)
+    for content_type_id, object_pk in set([key[:2] for key in keys]):
+        bump_object_version(content_type_id, object_pk)
@@ -0,0 +1,267 @@
+"""
+Streaming export of reviews with their segments, and the way back.
+
+The reviews are read in primary key chunks with values(), so neither the
+whole table nor model instances are held in memory. The segments of a chunk
+are loaded with one query. The records use the format of the import_reviews
+command, so an export can be imported again; RecordLoader turns records back
+into (unsaved) reviews and segments.
+"""
+import csv
+import datetime
+from cStringIO import StringIO
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import simplejson
+from reviews.managers import get_object_id
+from reviews.models import Category, CategorySegment
+import reviews
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'REVIEWS_EXPORT_CHUNK_SIZE', 1000)
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d')
+
+# record keys that are not copied to the review as they are
+SPECIAL_COLUMNS = ('id', 'object_id', 'content_type', 'category', 'segments',
+                   'flags', 'rating', 'submit_date', 'is_public', 'is_removed',
+                   'site', 'user', 'content_hash', 'idempotency_key')
+
+def get_export_queryset(content_type=None, category=None, site=None,
+                        since=None, until=None):
+    """
+    Returns the reviews to export. ``content_type`` is an "app_label.model"
+    string, ``category`` a category code, ``site`` a site id and
+    ``since``/``until`` limit the submit date (until is exclusive).
+    """
+    qs = reviews.get_model()._default_manager.all()
+    if content_type:
+        app_label, model = content_type.split('.', 1)
+        qs = qs.filter(content_type=ContentType.objects.get_by_natural_key(app_label, model))
+    if category:
+        qs = qs.filter(category__code=category)
+    if site:
+        qs = qs.filter(site__pk=site)
+    if since:
+        qs = qs.filter(submit_date__gte=since)
+    if until:
+        qs = qs.filter(submit_date__lt=until)
+    return qs
+
+def _field_names(model, exclude=()):
+    return [f.name for f in model._meta.fields
+            if not (f.rel and getattr(f.rel, 'parent_link', False))
+            and f.name not in exclude]
+
+def _serialize(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    return value
+
+def iter_records(qs, chunk_size=None):
+    """
+    Yields one dict per review of ``qs`` with its segments as list.
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    review_fields = _field_names(qs.model, exclude=('content_type', 'category'))
+    segment_model = reviews.get_segment_model()
+    segment_fields = _field_names(segment_model, exclude=('id', 'review', 'segment'))
+
+    pk_name = qs.model._meta.pk.name
+    value_names = review_fields + ['content_type__app_label',
+                                   'content_type__model', 'category__code']
+    if pk_name not in value_names:
+        value_names.append(pk_name)
+
+    last_pk = None
+    while True:
+        chunk_qs = qs.order_by(pk_name)
+        if last_pk is not None:
+            chunk_qs = chunk_qs.filter(pk__gt=last_pk)
+        chunk = list(chunk_qs.values(*value_names)[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][pk_name]
+
+        segments = {}
+        rows = segment_model._default_manager.filter(
+            review__in=[row[pk_name] for row in chunk]
+        ).order_by('segment__position').values('review', 'segment__title', *segment_fields)
+        for row in rows:
+            review_pk = row.pop('review')
+            row['segment'] = row.pop('segment__title')
+            segments.setdefault(review_pk, []).append(row)
+
+        for row in chunk:
+            record = dict([(key, _serialize(row[key])) for key in review_fields])
+            record['content_type'] = "%s.%s" % (row['content_type__app_label'],
+                                                row['content_type__model'])
+            record['category'] = row['category__code']
+            record['segments'] = segments.get(row[pk_name], [])
+            yield record
+
+def get_record(review, segments):
+    """
+    Returns the record of a review and its segments, which need not be saved.
+    """
+    review_model = review.__class__
+    record = {}
+    for name in _field_names(review_model, exclude=('content_type', 'category')):
+        record[name] = _serialize(getattr(review, review_model._meta.get_field(name).attname))
+    content_type = ContentType.objects.get_for_id(review.content_type_id)
+    record['content_type'] = "%s.%s" % (content_type.app_label, content_type.model)
+    record['category'] = review.category.code
+
+    record['segments'] = []
+    for segment in segments:
+        segment_model = segment.__class__
+        item = dict([(name, _serialize(getattr(segment, name))) for name in
+                     _field_names(segment_model, exclude=('id', 'review', 'segment'))])
+        item['segment'] = Category.objects.get_segment(segment.segment_id).title
+        record['segments'].append(item)
+    return record
+
+def iter_jsonl(records):
+    """
+    Yields the records as JSON lines.
+    """
+    for record in records:
+        yield simplejson.dumps(record) + '\n'
+
+def iter_csv(records, categories=None):
+    """
+    Yields the records as CSV lines. The segments become "segment:<title>:..."
+    columns of all segments of the given category codes (or all categories).
+    """
+    segments = CategorySegment.objects.order_by('category', 'position')
+    if categories:
+        segments = segments.filter(category__code__in=categories)
+    titles = []
+    for title in segments.values_list('title', flat=True):
+        if title not in titles:
+            titles.append(title)
+
+    header = None
+    for record in records:
+        if header is None:
+            columns = [key for key in sorted(record.keys()) if key != 'segments']
+            header = columns + ["segment:%s:%s" % (title, attr)
+                                for title in titles for attr in ('rating', 'text')]
+            yield _csv_line(header)
+
+        row = [record[key] for key in columns]
+        by_title = dict([(segment['segment'], segment) for segment in record['segments']])
+        for title in titles:
+            segment = by_title.get(title, {})
+            row.extend([segment.get('rating'), segment.get('text')])
+        yield _csv_line(row)
+
+def _csv_line(values):
+    buffer = StringIO()
+    row = []
+    for value in values:
+        if value is None:
+            value = ''
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        row.append(value)
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue()
+
+def parse_date(value):
+    """
+    Parses the dates of a record, None for empty values.
+    """
+    if not value:
+        return None
+    for format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date %r" % value)
+
+class RecordLoader(object):
+    """
+    Builds unsaved reviews and segments from records, the reverse of
+    iter_records(). Content types, categories and category segments are
+    loaded once per loader.
+
+    The review id of a record is only used if ``keep_pk`` is True, e.g. to
+    restore archived reviews.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, keep_pk=False):
+        self.using = using
+        self.keep_pk = keep_pk
+        self.review_model = reviews.get_model()
+        self.segment_model = reviews.get_segment_model()
+        self.review_fields = set([f.name for f in self.review_model._meta.fields])
+        self.content_types = {}
+        self.categories = {}
+
+    def get_content_type(self, name):
+        if name not in self.content_types:
+            app_label, model = name.split('.', 1)
+            self.content_types[name] = ContentType.objects.db_manager(
+                self.using).get_by_natural_key(app_label, model)
+        return self.content_types[name]
+
+    def get_category(self, code):
+        """
+        Returns the category and a dict of its segment ids by title.
+        """
+        if code not in self.categories:
+            category = Category.objects.using(self.using).get(code=code)
+            segments = dict([(segment.title, segment.pk) for segment in
+                             category.categorysegment_set.using(self.using)])
+            self.categories[code] = (category, segments)
+        return self.categories[code]
+
+    def parse_bool(self, value, default):
+        if value in (None, ''):
+            return default
+        if isinstance(value, basestring):
+            return value.lower() in ('1', 'true', 'yes')
+        return bool(value)
+
+    def build(self, record):
+        """
+        Returns an unsaved review and its unsaved segments for a record.
+        """
+        content_type = self.get_content_type(record['content_type'])
+        category, segment_ids = self.get_category(record['category'])
+
+        data = dict([(str(key), value) for key, value in record.items()
+                     if key in self.review_fields and key not in SPECIAL_COLUMNS])
+        review = self.review_model(**data)
+        if self.keep_pk:
+            # with multi-table inheritance the parent link is the primary key
+            review.id = review.pk = int(record['id'])
+        review.content_type = content_type
+        review.object_pk = unicode(record['object_pk'])
+        review.object_id = get_object_id(content_type.model_class(), review.object_pk)
+        review.category = category
+        review.rating = int(record['rating'])
+        review.submit_date = parse_date(record.get('submit_date')) or datetime.datetime.now()
+        review.is_public = self.parse_bool(record.get('is_public'), True)
+        review.is_removed = self.parse_bool(record.get('is_removed'), False)
+        review.site_id = int(record.get('site') or settings.SITE_ID)
+        review.user_id = record.get('user') and int(record['user']) or None
+        review.ip_address = review.ip_address or None
+        if hasattr(review, 'get_content_hash'):
+            review.content_hash = review.get_content_hash()
+
+        segments = []
+        for item in record.get('segments') or []:
+            segment = self.segment_model(
+                segment_id = segment_ids[item['segment']],
+                rating     = int(item['rating']),
+                text       = item.get('text', ''),
+            )
+            for key, value in item.items():
+                if key not in ('segment', 'rating', 'text'):
+                    setattr(segment, str(key), value)
+            segments.append(segment)
+        return review, segments
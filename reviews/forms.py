@@ -5,6 +5,7 @@ from django import forms
 from django.forms.util import ErrorDict
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils.crypto import salted_hmac, constant_time_compare
 from django.utils.encoding import force_unicode
 from django.utils.hashcompat import sha_constructor
@@ -12,13 +13,18 @@ from django.utils.text import get_text_list
 from django.utils.translation import ungettext, ugettext_lazy as _
 from django.forms.formsets import formset_factory
 from reviews.models import Review, ReviewSegment, Category, CategorySegment
-from reviews import signing
+from reviews import tokens
+from reviews.profanity import get_matcher
 
 REVIEW_MAX_LENGTH = getattr(settings,'REVIEW_MAX_LENGTH', 3000)
 REVIEWS_ALLOW_PROFANITIES = getattr(settings,'REVIEWS_ALLOW_PROFANITIES', False)
+REVIEWS_PROFANITIES_WHOLE_WORDS = getattr(settings,'REVIEWS_PROFANITIES_WHOLE_WORDS', False)
 REVIEW_MIN_RATING = getattr(settings,'REVIEW_MIN_RATING', 1)
 REVIEW_MAX_RATING = getattr(settings,'REVIEW_MAX_RATING', 5)
 
+# salt of the signed category of the review forms
+CATEGORY_TOKEN_SALT = 'category'
+
 RATING_CHOICES = (
     ('1', 'Very poor'),
     ('2', 'Not that bad'),
@@ -30,32 +36,37 @@ RATING_CHOICES = (
 
 class SignedCharField(forms.CharField):
     """
-    SignedCharField is a normal char field, but the content is signed with
-    the django Signer to prevent manipulation. Best used together with
+    SignedCharField is a normal char field, but the content is signed (see
+    reviews.tokens) to prevent manipulation. ``salt`` separates the values
+    of different fields.
     """
 
+    def __init__(self, *args, **kwargs):
+        self.salt = kwargs.pop('salt', '')
+        super(SignedCharField, self).__init__(*args, **kwargs)
+
     def prepare_value(self, value):
         # test if the value is already signed. if yes, we do not resign it
-        try:
-            signing.loads(value)
+        if value is None or tokens.is_signed(value, self.salt):
             return value
-        except signing.BadSignature:
-            return signing.dumps(value)
+        return tokens.dumps(value, self.salt)
 
     def to_python(self, value):
         """ a broken/manipulated value will raise an exception of
         type signing.BadSignature. We do not catch it, it should raise """
 
-        original = signing.loads(value)
+        original = tokens.loads(value, self.salt)
         return original
 
 def clean_text(text):
     """
     If REVIEWS_ALLOW_PROFANITIES is False, check that the review doesn't
-    contain anything in PROFANITIES_LIST.
+    contain anything in PROFANITIES_LIST. With REVIEWS_PROFANITIES_WHOLE_WORDS
+    only whole words are found.
     """
     if REVIEWS_ALLOW_PROFANITIES == False:
-        bad_words = [w for w in settings.PROFANITIES_LIST if w in text.lower()]
+        bad_words = get_matcher(settings.PROFANITIES_LIST,
+                                REVIEWS_PROFANITIES_WHOLE_WORDS).find_all(text)
         if bad_words:
             plural = len(bad_words) > 1
             raise forms.ValidationError(ungettext(
@@ -173,7 +184,8 @@ class ReviewDetailsForm(ReviewSecurityForm):
     signature attached. This way we can route it through the form, but can be
     sure that it is not changed. If not done this way, the user could change the
     category of the review, which is not good """
-    category      = SignedCharField(max_length=200, widget=forms.HiddenInput)
+    category      = SignedCharField(max_length=200, widget=forms.HiddenInput,
+                                    salt=CATEGORY_TOKEN_SALT)
 
     def __init__(self, *args, **kwargs):
         """
@@ -204,6 +216,7 @@ class ReviewDetailsForm(ReviewSecurityForm):
 
         ReviewModel = self.get_review_model()
         new = ReviewModel(**self.get_review_create_data())
+        new.idempotency_key = self.get_idempotency_key()
         new = self.check_for_duplicate_review(new)
 
         return new
@@ -230,7 +243,7 @@ class ReviewDetailsForm(ReviewSecurityForm):
             text         = self.cleaned_data["text"],
             title        = self.cleaned_data["title"],
             rating       = self.cleaned_data["rating"],
-            category     = Category.objects.get(code=self.cleaned_data["category"]),
+            category     = Category.objects.get_by_code(self.cleaned_data["category"]),
             submit_date  = datetime.datetime.now(),
             site_id      = settings.SITE_ID,
             is_public    = True,
@@ -260,9 +273,7 @@ class ReviewDetailsForm(ReviewSecurityForm):
         if not category:
             category = self.category
 
-        cat = Category.objects.get(code=category)
-
-        for segment in cat.categorysegment_set.order_by('position'):
+        for segment in Category.objects.get_segments(category):
             initial.append({
                   'categorysegment_id': segment.id,
                   'text': ''
@@ -273,22 +284,41 @@ class ReviewDetailsForm(ReviewSecurityForm):
 
         return formset
 
+    def get_idempotency_key(self):
+        """
+        Returns the key of this form submission: the security hash and
+        timestamp of the rendered form, the author and the category. Posting
+        the same form twice gives the same key. Assumes a valid form.
+        """
+        value = u"-".join([
+            self.cleaned_data["security_hash"],
+            unicode(self.cleaned_data["timestamp"]),
+            self.cleaned_data["name"],
+            self.cleaned_data["email"],
+            unicode(self.cleaned_data["category"]),
+        ])
+        return sha_constructor(value.encode('utf-8')).hexdigest()
+
     def check_for_duplicate_review(self, new):
         """
         Check that a submitted review isn't a duplicate. This might be caused
         by someone posting a review twice. If it is a dup, silently return the *previous* review.
+
+        Duplicates are found by the indexed idempotency key and content hash
+        (see Review.get_content_hash()) instead of comparing texts.
         """
-        possible_duplicates = self.get_review_model()._default_manager.using(
+        manager = self.get_review_model()._default_manager.using(
             self.target_object._state.db
-        ).filter(
-            content_type = new.content_type,
-            object_pk = new.object_pk,
-            user_name = new.user_name,
-            user_email = new.user_email,
         )
-        for old in possible_duplicates:
-            if old.submit_date.date() == new.submit_date.date() and old.text == new.text:
-                return old
+        if new.idempotency_key:
+            try:
+                return manager.get(idempotency_key=new.idempotency_key)
+            except ObjectDoesNotExist:
+                pass
+        new.content_hash = new.get_content_hash()
+        possible_duplicates = manager.filter(content_hash=new.content_hash)[:1]
+        if possible_duplicates:
+            return possible_duplicates[0]
 
         return new
 
@@ -316,10 +346,8 @@ class ReviewSegmentBaseForm(forms.Form):
         Can be used to show the title of the category segment and load other
         data related to it.
         """
-        if 'segment' in self:
-            return self.segment
-
-        self.segment = CategorySegment.objects.get(pk=self.initial['categorysegment_id'])
+        if not hasattr(self, 'segment'):
+            self.segment = Category.objects.get_segment(self.initial['categorysegment_id'])
         return self.segment
 
 class ReviewSegmentForm(ReviewSegmentBaseForm):
@@ -0,0 +1,103 @@
+"""
+Fragment cache of rendered review lists.
+
+Every reviewed object has a version, the time of the last change of its
+reviews as timestamp. It is part of the keys of all cached fragments of the
+object (and of the ETag and Last-Modified headers of the JSON API) and is
+changed whenever a review of the object is saved, deleted, posted or flagged.
+A changed review thus makes the old fragments unreachable instead of serving
+them until they expire.
+
+The version is kept in the django cache and stored as last_change of the
+review summaries of the object, which it is read from after a restart or an
+eviction (custom review models that don't extend Review have no summaries,
+their versions only live in the cache). The cache has to be shared by all processes (memcached, database,
+...): with a per-process cache like locmem, a change is only seen by the
+process that made it.
+"""
+import datetime
+import time
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils.encoding import smart_str, force_unicode
+from django.utils.hashcompat import md5_constructor
+
+def get_version_key(content_type_id, object_pk):
+    return 'reviews.version.%s.%s' % (content_type_id,
+                                      md5_constructor(smart_str(object_pk)).hexdigest())
+
+def get_version(changed):
+    """
+    Returns the version of a change time.
+    """
+    return repr(time.mktime(changed.timetuple()) + changed.microsecond / 1e6)
+
+def get_stored_versions(content_type_id, object_pks):
+    """
+    Returns the versions of the given objects from the last_change of their
+    review summaries as dict by object_pk. Objects without summaries have
+    no reviews and version "0".
+    """
+    from reviews.managers import get_object_hash
+    from reviews.models import ReviewSummary
+    rows = ReviewSummary.objects.filter(
+        content_type__pk = content_type_id,
+        object_hash__in  = [get_object_hash(object_pk) for object_pk in object_pks],
+    ).values('object_pk').annotate(last_change=Max('last_change')).order_by()
+    versions = dict([(force_unicode(object_pk), '0') for object_pk in object_pks])
+    for row in rows:
+        versions[row['object_pk']] = get_version(row['last_change'])
+    return versions
+
+def get_object_version(content_type_id, object_pk):
+    """
+    Returns the current version of the reviews of an object.
+    """
+    return get_object_versions(content_type_id, [object_pk])[0]
+
+def get_object_versions(content_type_id, object_pks):
+    """
+    Returns the versions of many objects of one content type with one cache
+    round trip, as list in the order of ``object_pks``.
+    """
+    keys = [get_version_key(content_type_id, object_pk) for object_pk in object_pks]
+    versions = cache.get_many(keys)
+    missing = [(key, object_pk) for key, object_pk in zip(keys, object_pks)
+               if key not in versions]
+    if missing:
+        stored = get_stored_versions(content_type_id,
+                                     [object_pk for key, object_pk in missing])
+        for key, object_pk in missing:
+            cache.add(key, stored[force_unicode(object_pk)])
+        # another process may have added a newer version in between
+        added = cache.get_many([key for key, object_pk in missing])
+        for key, object_pk in missing:
+            versions[key] = added.get(key, stored[force_unicode(object_pk)])
+    return [versions[key] for key in keys]
+
+def bump_object_version(content_type_id, object_pk):
+    """
+    Invalidates all cached fragments of an object.
+    """
+    from reviews.managers import get_object_hash
+    from reviews.models import ReviewSummary
+    now = datetime.datetime.now()
+    ReviewSummary.objects.filter(
+        content_type__pk = content_type_id,
+        object_hash      = get_object_hash(object_pk),
+    ).update(last_change=now)
+    cache.set(get_version_key(content_type_id, object_pk), get_version(now))
+
+def get_fragment_key(name, obj, category, args):
+    """
+    Returns the cache key of a fragment of the tag ``name`` for the reviews of
+    ``obj`` in ``category``. ``args`` are the other tag arguments the output
+    depends on (page, order, template, ...).
+    """
+    ctype = ContentType.objects.get_for_model(obj)
+    version = get_object_version(ctype.pk, obj.pk)
+    key = repr((name, ctype.pk, smart_str(obj.pk), category, settings.SITE_ID,
+                tuple(args), version))
+    return 'reviews.fragment.%s' % md5_constructor(key).hexdigest()
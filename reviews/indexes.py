@@ -0,0 +1,134 @@
+"""
+Composite indexes of the review tables.
+
+Django 1.3 can't declare indexes over several columns, so they are created
+by the migrations and, for databases built with syncdb (e.g. the test
+database with SOUTH_TESTS_MIGRATE = False), by a post_syncdb handler. Both
+use create_index(), which looks for an index on the same columns first, so
+an index is never created twice, whoever comes first.
+
+South rebuilds SQLite tables to add or change columns and only keeps their
+unique indexes. Migration 0019 recreates the indexes dropped that way, 0020
+those of the summary table it rebuilds itself; a later migration that changes
+the review tables on SQLite has to do the same.
+"""
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.utils.hashcompat import sha_constructor
+
+# (table, columns) of the indexes created by the migrations
+INDEXES = (
+    # review lookups of the template tags, see 0008
+    ('reviews_review', ('content_type_id', 'object_id', 'site_id', 'is_public',
+                        'is_removed', 'id')),
+    # keyset pagination of the review lists by date, see 0009
+    ('reviews_review', ('content_type_id', 'object_id', 'site_id',
+                        'is_public', 'is_removed', 'submit_date', 'id')),
+    # keyset pagination by rating, see 0009
+    ('reviews_review', ('content_type_id', 'object_id', 'site_id',
+                        'is_public', 'is_removed', 'rating', 'submit_date',
+                        'id')),
+    # category toplists, see 0010
+    ('reviews_reviewsummary', ('site_id', 'category_id', 'score')),
+    # content type toplists, see 0010
+    ('reviews_reviewsummary', ('site_id', 'content_type_id', 'score')),
+    # moderation queue, see 0015
+    ('reviews_review', ('is_public', 'is_removed', 'submit_date', 'id')),
+    # most flagged reviews, see 0016
+    ('reviews_review', ('removal_suggestions', 'submit_date')),
+)
+
+def get_index_name(table, columns):
+    return '%s_%s' % (table, sha_constructor(','.join(columns)).hexdigest()[:10])
+
+def get_indexes(table, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the column tuples of the indexes of ``table`` as dict with the
+    index names as values, None if the database can't be asked.
+    """
+    connection = connections[using]
+    vendor = getattr(connection, 'vendor', None)
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    indexes = {}
+    if vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list(%s)' % qn(table))
+        for name in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('PRAGMA index_info(%s)' % qn(name))
+            indexes[tuple([row[2] for row in cursor.fetchall()])] = name
+    elif vendor == 'postgresql':
+        cursor.execute("SELECT i.relname, x.indexrelid, x.indnatts FROM pg_index x "
+                       "JOIN pg_class t ON t.oid = x.indrelid "
+                       "JOIN pg_class i ON i.oid = x.indexrelid "
+                       "WHERE t.relname = %s", [table])
+        for name, oid, count in cursor.fetchall():
+            columns = []
+            for number in range(1, count + 1):
+                cursor.execute("SELECT pg_get_indexdef(%s, %s, true)", [oid, number])
+                columns.append(cursor.fetchone()[0])
+            indexes[tuple(columns)] = name
+    elif vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % qn(table))
+        columns = {}
+        # Key_name, Seq_in_index and Column_name
+        for row in cursor.fetchall():
+            columns.setdefault(row[2], []).append((row[3], row[4]))
+        for name, names in columns.items():
+            indexes[tuple([column for seq, column in sorted(names)])] = name
+    else:
+        return None
+    return indexes
+
+def create_index(table, columns, using=DEFAULT_DB_ALIAS):
+    """
+    Creates an index on ``columns`` of ``table`` unless there is one.
+    Returns whether it was created.
+    """
+    columns = tuple(columns)
+    indexes = get_indexes(table, using)
+    if indexes is not None and columns in indexes:
+        return False
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    connection.cursor().execute('CREATE INDEX %s ON %s (%s)' % (
+        qn(get_index_name(table, columns)), qn(table),
+        ', '.join([qn(column) for column in columns])))
+    return True
+
+def drop_index(table, columns, using=DEFAULT_DB_ALIAS):
+    """
+    Drops the index on ``columns`` of ``table``, if there is one.
+    """
+    indexes = get_indexes(table, using)
+    if indexes is None:
+        name = get_index_name(table, columns)
+    else:
+        name = indexes.get(tuple(columns))
+        if name is None:
+            return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    if getattr(connection, 'vendor', None) == 'mysql':
+        sql = 'DROP INDEX %s ON %s' % (qn(name), qn(table))
+    else:
+        sql = 'DROP INDEX %s' % qn(name)
+    connection.cursor().execute(sql)
+
+def create_indexes(sender, created_models, db=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_syncdb handler: creates the INDEXES of the created tables whose
+    columns exist (South sends the signal after a partial migration, too).
+    """
+    tables = set([model._meta.db_table for model in created_models])
+    connection = connections[db]
+    created = False
+    for table, columns in INDEXES:
+        if table not in tables:
+            continue
+        cursor = connection.cursor()
+        existing = [row[0] for row in
+                    connection.introspection.get_table_description(cursor, table)]
+        if [column for column in columns if column not in existing]:
+            continue
+        created = create_index(table, columns, db) or created
+    if created:
+        transaction.commit_unless_managed(using=db)
@@ -0,0 +1,6 @@
+from django.db.models import signals
+from reviews import models as reviews_app
+from reviews.indexes import create_indexes
+
+signals.post_syncdb.connect(create_indexes, sender=reviews_app,
+    dispatch_uid="reviews.indexes.create_indexes")
@@ -0,0 +1,59 @@
+import datetime
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from reviews.models import ArchivedReview
+
+REVIEWS_ARCHIVE_AFTER_DAYS = getattr(settings, 'REVIEWS_ARCHIVE_AFTER_DAYS', None)
+
+class Command(BaseCommand):
+    args = '[review id ...]'
+    help = "Moves removed reviews, and reviews older than the retention " \
+           "window, with their segments and flags into the compressed review " \
+           "archive. With --restore, moves the archived reviews with the " \
+           "given review ids back."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than', dest='older_than', type='int',
+            default=REVIEWS_ARCHIVE_AFTER_DAYS,
+            help='Also archive reviews submitted more than this many days ago '
+                 '(default: REVIEWS_ARCHIVE_AFTER_DAYS, none if not set).'),
+        make_option('--keep-removed', dest='removed', action='store_false',
+            default=True, help='Do not archive removed reviews.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Reviews moved per transaction (default 1000).'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+            help='Only count the reviews that would be archived.'),
+        make_option('--restore', dest='restore', action='store_true', default=False,
+            help='Restore the archived reviews with the given review ids.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['restore']:
+            if not args:
+                raise CommandError("--restore needs the ids of the reviews to restore")
+            archived = ArchivedReview.objects.filter(review_id__in=[int(pk) for pk in args])
+            restored, taken = ArchivedReview.objects.restore(archived)
+            if verbosity:
+                self.stdout.write("Restored %s reviews.\n" % restored)
+            if taken:
+                raise CommandError("The ids of the archived reviews %s belong to other "
+                                   "reviews now; they were not restored." %
+                                   ", ".join([str(pk) for pk in taken]))
+            return
+
+        older_than = None
+        if options['older_than']:
+            older_than = datetime.datetime.now() - \
+                         datetime.timedelta(days=options['older_than'])
+        qs = ArchivedReview.objects.get_archivable(options['removed'], older_than)
+
+        if options['dry_run']:
+            self.stdout.write("%s reviews would be archived.\n" % qs.count())
+            return
+
+        archived = ArchivedReview.objects.archive(qs, options['batch_size'])
+        if verbosity:
+            self.stdout.write("Archived %s reviews.\n" % archived)
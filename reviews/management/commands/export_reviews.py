@@ -0,0 +1,61 @@
+import datetime
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+from reviews.export import get_export_queryset, iter_records, iter_jsonl, iter_csv
+
+class Command(NoArgsCommand):
+    help = "Exports reviews with their segments as JSONL or CSV, in the " \
+           "format read by import_reviews. Runs in constant memory."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+            help='Output format, "jsonl" (default) or "csv".'),
+        make_option('--output', '-o', dest='output', default=None,
+            help='File to write to. Default: stdout.'),
+        make_option('--content-type', dest='content_type', default=None,
+            help='Only reviews of this content type ("app_label.model").'),
+        make_option('--category', dest='category', default=None,
+            help='Only reviews of the category with this code.'),
+        make_option('--site', dest='site', type='int', default=None,
+            help='Only reviews of the site with this id.'),
+        make_option('--since', dest='since', default=None,
+            help='Only reviews submitted at or after this date (YYYY-MM-DD).'),
+        make_option('--until', dest='until', default=None,
+            help='Only reviews submitted before this date (YYYY-MM-DD).'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=None,
+            help='Reviews read per query.'),
+    )
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise CommandError("Invalid date %r, use YYYY-MM-DD" % value)
+
+    def handle_noargs(self, **options):
+        if options['format'] not in ('jsonl', 'csv'):
+            raise CommandError("--format must be jsonl or csv")
+
+        qs = get_export_queryset(
+            content_type = options['content_type'],
+            category     = options['category'],
+            site         = options['site'],
+            since        = self.parse_date(options['since']),
+            until        = self.parse_date(options['until']),
+        )
+        records = iter_records(qs, options['chunk_size'])
+        if options['format'] == 'csv':
+            lines = iter_csv(records, options['category'] and [options['category']])
+        else:
+            lines = iter_jsonl(records)
+
+        if options['output']:
+            output = open(options['output'], 'wb')
+        else:
+            output = self.stdout
+        for line in lines:
+            output.write(line)
+        if options['output']:
+            output.close()
@@ -0,0 +1,152 @@
+import csv
+import sys
+import time
+from optparse import make_option
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import simplejson
+from reviews.bulk import bulk_insert, update_summaries
+from reviews.export import RecordLoader
+from reviews.models import Category
+from reviews import signals
+import reviews
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = """Imports reviews and their segments from a JSONL or CSV file ("-"
+reads stdin).
+
+Every record needs content_type ("app_label.model"), object_pk, category
+(code), title, text and rating; user_name, user_email, user (id),
+submit_date, ip_address, is_public, is_removed and site (id) are optional.
+Other columns are set on the review if the review model has such a field.
+
+Segments are given per category segment title. In JSONL as list:
+  "segments": [{"segment": "Handling", "rating": 4, "text": "..."}]
+In CSV as columns "segment:<title>:rating" and "segment:<title>:text".
+
+The segments of a batch are written with one multi-row insert. The reviews
+need their ids for the segments: they are inserted one by one (without
+save() and its summary updates) unless the database returns the ids of a
+multi-row insert, which Django 1.3 and custom review models with
+multi-table inheritance don't support."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='Input format, "jsonl" or "csv". Default: from the file name.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Reviews per insert batch and transaction (default 1000).'),
+        make_option('--signals', dest='signals', default='batch',
+            help='How to send the posted signals: "each" sends review_was_posted '
+                 'for every review, "batch" sends reviews_were_posted once per '
+                 'batch (default), "none" sends nothing.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to import into.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: import_reviews %s" % self.args)
+        if options['signals'] not in ('each', 'batch', 'none'):
+            raise CommandError("--signals must be one of each, batch or none")
+
+        path = args[0]
+        format = options['format'] or (path.endswith('.csv') and 'csv' or 'jsonl')
+        if format not in ('jsonl', 'csv'):
+            raise CommandError("--format must be jsonl or csv")
+
+        self.using = options['database']
+        self.send_signals = options['signals']
+        self.verbosity = int(options.get('verbosity', 1))
+        self.review_model = reviews.get_model()
+        self.loader = RecordLoader(using=self.using)
+
+        if path == '-':
+            input = sys.stdin
+        else:
+            input = open(path, 'rb')
+
+        if format == 'csv':
+            records = self.read_csv(input)
+        else:
+            records = self.read_jsonl(input)
+
+        self.started = time.time()
+        self.imported = 0
+        self.imported_segments = 0
+        batch = []
+        for number, record in enumerate(records):
+            try:
+                batch.append(self.loader.build(record))
+            except (KeyError, ValueError, ContentType.DoesNotExist,
+                    Category.DoesNotExist), e:
+                raise CommandError("Record %s: %s: %s" %
+                                   (number + 1, e.__class__.__name__, e))
+            if len(batch) >= options['batch_size']:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+
+        if self.verbosity:
+            self.stdout.write("Imported %s reviews in %.1f seconds.\n" %
+                              (self.imported, time.time() - self.started))
+
+    def read_jsonl(self, input):
+        for line in input:
+            line = line.strip()
+            if line:
+                yield simplejson.loads(line)
+
+    def read_csv(self, input):
+        for row in csv.DictReader(input):
+            record = {}
+            segments = {}
+            for column, value in row.items():
+                value = (value or '').decode('utf-8')
+                if column.startswith('segment:'):
+                    prefix, title, attr = column.split(':', 2)
+                    segments.setdefault(title, {'segment': title})[attr] = value
+                else:
+                    record[column] = value
+            record['segments'] = [s for s in segments.values() if s.get('rating')]
+            yield record
+
+    def write(self, batch):
+        """
+        Inserts one batch of reviews and segments in a transaction and
+        updates the summaries of the reviewed objects.
+        """
+        review_list = [review for review, segments in batch]
+        segment_list = []
+
+        with transaction.commit_on_success(using=self.using):
+            bulk_insert(review_list, using=self.using, set_pks=True)
+            for review, segments in batch:
+                for segment in segments:
+                    segment.review_id = review.pk
+                    segment_list.append(segment)
+            bulk_insert(segment_list, using=self.using)
+            update_summaries(review_list)
+
+        if self.send_signals == 'each':
+            for review in review_list:
+                signals.review_was_posted.send(
+                    sender  = review.__class__,
+                    review  = review,
+                    request = None
+                )
+        elif self.send_signals == 'batch':
+            signals.reviews_were_posted.send(
+                sender  = self.review_model,
+                reviews = review_list,
+                request = None
+            )
+
+        self.imported += len(review_list)
+        self.imported_segments += len(segment_list)
+        if self.verbosity:
+            elapsed = max(time.time() - self.started, 0.001)
+            self.stdout.write("%s reviews, %s segments imported (%.0f reviews/s)\n" % (
+                self.imported, self.imported_segments, self.imported / elapsed))
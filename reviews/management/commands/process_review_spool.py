@@ -0,0 +1,34 @@
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from reviews.models import SpooledReview
+
+class Command(NoArgsCommand):
+    help = "Saves the reviews posted while REVIEWS_SPOOL is on, in batches. " \
+           "Processes the spool until it is empty, or keeps polling it with " \
+           "--loop. Run only one worker at a time."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+            help='Reviews saved per transaction (default 100).'),
+        make_option('--max-attempts', dest='max_attempts', type='int', default=5,
+            help='Skip submissions that failed this many times (default 5).'),
+        make_option('--loop', dest='loop', action='store_true', default=False,
+            help='Keep running and poll the spool when it is empty.'),
+        make_option('--interval', dest='interval', type='float', default=2.0,
+            help='Seconds to wait between polls with --loop (default 2).'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            saved, discarded, failed = SpooledReview.objects.process(
+                options['batch_size'], options['max_attempts'])
+            if verbosity and (saved or discarded or failed):
+                self.stdout.write("Saved %s reviews, discarded %s, %s failed.\n" %
+                                  (saved, discarded, failed))
+            if saved + discarded + failed < options['batch_size']:
+                # the spool is empty, up to the given up submissions
+                if not options['loop']:
+                    return
+                time.sleep(options['interval'])
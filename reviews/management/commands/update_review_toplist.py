@@ -0,0 +1,27 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from reviews.models import Category, ReviewSummary, SegmentSummary
+
+class Command(NoArgsCommand):
+    help = "Recalculates the category averages and toplist scores of the " \
+           "review summaries. Scores are updated as reviews are posted; run " \
+           "this regularly so they follow changes of the category averages."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--category', dest='category', default=None,
+            help='Only update the scores of the category with this code.'),
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Rebuild all review and segment summaries from the review '
+                 'tables first, e.g. after loading reviews with loaddata.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options.get('rebuild'):
+            # rebuild_all() updates the scores of all categories as well
+            ReviewSummary.objects.rebuild_all()
+            SegmentSummary.objects.rebuild_all()
+            return
+        category_id = None
+        if options.get('category'):
+            category_id = Category.objects.get(code=options['category']).pk
+        ReviewSummary.objects.update_scores(category_id)
@@ -1,14 +1,277 @@
-from django.db import models
+import datetime
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models import Count, Sum, Min, Max, F, Q
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils.encoding import force_unicode
+from django.utils.hashcompat import sha_constructor
+
+# The toplist ranks by a bayesian average: every object is treated as if it had
+# REVIEWS_TOPLIST_PRIOR_WEIGHT additional reviews with the average rating of
+# its category. Objects with few reviews are thus pulled to the category mean.
+REVIEWS_TOPLIST_PRIOR_WEIGHT = getattr(settings, 'REVIEWS_TOPLIST_PRIOR_WEIGHT', 10)
+REVIEWS_TOPLIST_PRIOR_TIMEOUT = getattr(settings, 'REVIEWS_TOPLIST_PRIOR_TIMEOUT', 60 * 60)
+# The prior of a category is only cached once it averages this many reviews.
+# Below, it is recalculated on every change and the whole category is scored
+# with it, so all scores of a toplist always use the same prior.
+REVIEWS_TOPLIST_PRIOR_MIN_REVIEWS = getattr(settings, 'REVIEWS_TOPLIST_PRIOR_MIN_REVIEWS', 100)
+PRIOR_CACHE_VERSION_KEY = 'reviews.toplist.mean.version'
+
+# Reviews with this many removal suggestions (see ReviewFlag) are made
+# non-public until a moderator approves them; None never hides reviews.
+REVIEWS_FLAG_HIDE_THRESHOLD = getattr(settings, 'REVIEWS_FLAG_HIDE_THRESHOLD', None)
+
+# prefetch() selects the reviews of this many objects with one statement
+REVIEWS_PREFETCH_CHUNK_SIZE = 100
+
+# Categories and their segments are cached in every process. The version in the
+# django cache is changed whenever one of them is saved or deleted, so all
+# processes reload them on their next access.
+CATEGORY_CACHE_VERSION_KEY = 'reviews.categories.version'
+
+# Also match reviews without object_id by object_pk. Only meant for the time
+# migration 0007 fills the column of an existing table: the OR condition
+# keeps the databases from using the lookup and order indexes.
+REVIEWS_OBJECT_ID_FALLBACK = getattr(settings, 'REVIEWS_OBJECT_ID_FALLBACK', False)
+
+INTEGER_FIELD_TYPES = ('AutoField', 'IntegerField', 'BigIntegerField',
+                       'SmallIntegerField', 'PositiveIntegerField',
+                       'PositiveSmallIntegerField')
+
+def get_object_id(model, object_pk):
+    """
+    Returns ``object_pk`` as integer if ``model`` has an integer primary key,
+    otherwise None. Used to fill and to query the indexed object_id column of
+    the reviews.
+    """
+    if model is None or object_pk is None:
+        return None
+    pk = model._meta.pk
+    # follow parent links of multi-table inheritance to the real key
+    while pk.rel:
+        pk = pk.rel.get_related_field()
+    if pk.get_internal_type() not in INTEGER_FIELD_TYPES:
+        return None
+    try:
+        return int(object_pk)
+    except (TypeError, ValueError):
+        return None
+
+def get_object_hash(object_pk):
+    """
+    Returns the SHA-1 hex digest of ``object_pk``, the indexed key of the
+    review summaries.
+    """
+    return sha_constructor(force_unicode(object_pk).encode('utf-8')).hexdigest()
+
+def filter_object(qs, model, object_pk, prefix=''):
+    """
+    Restricts a review queryset to one object of ``model``. Uses the indexed
+    integer object_id column if the model has an integer primary key, the
+    object_pk string otherwise. ``prefix`` is the lookup path to the review,
+    e.g. "review__" for segment querysets.
+
+    object_id is filled whenever a review is saved, so reviews of integer
+    keyed models are only looked up by it. With REVIEWS_OBJECT_ID_FALLBACK
+    reviews that don't have it yet (while migration 0007 runs) are matched by
+    object_pk as well.
+    """
+    object_id = get_object_id(model, object_pk)
+    if object_id is not None:
+        if not REVIEWS_OBJECT_ID_FALLBACK:
+            return qs.filter(**{prefix + 'object_id': object_id})
+        return qs.filter(Q(**{prefix + 'object_id': object_id}) |
+                         Q(**{prefix + 'object_id__isnull': True,
+                              prefix + 'object_pk': force_unicode(object_pk)}))
+    return qs.filter(**{prefix + 'object_pk': force_unicode(object_pk)})
+
+def get_object_reviews(model, target_model, object_pk, site_id=None):
+    """
+    Returns the reviews (of the review ``model``) of the object ``object_pk``
+    of ``target_model`` that are shown on the site: public and, depending on
+    REVIEWS_HIDE_REMOVED, not removed.
+    """
+    if site_id is None:
+        site_id = settings.SITE_ID
+    qs = model._default_manager.filter(
+        content_type = ContentType.objects.get_for_model(target_model),
+        site__pk     = site_id,
+    )
+    field_names = [f.name for f in model._meta.fields]
+    if 'object_id' in field_names:
+        qs = filter_object(qs, target_model, object_pk)
+    else:
+        qs = qs.filter(object_pk=force_unicode(object_pk))
+
+    # The is_public and is_removed fields are implementation details of the
+    # built-in review model's spam filtering system, so they might not
+    # be present on a custom comment model subclass. If they exist, we
+    # should filter on them.
+    if 'is_public' in field_names:
+        qs = qs.filter(is_public=True)
+    if getattr(settings, 'REVIEWS_HIDE_REMOVED', True) and 'is_removed' in field_names:
+        qs = qs.filter(is_removed=False)
+    return qs
+
+class CategoryManager(models.Manager):
+    """
+    Manager of Category with a process wide cache of all categories and their
+    segments, like the cache of the ContentTypeManager. Categories change
+    rarely, but are needed for every review form and every posted review.
+    """
+
+    # shared by all instances of the manager
+    _cache = {}
+
+    def _get_cache(self):
+        version = cache.get(CATEGORY_CACHE_VERSION_KEY)
+        if version is None:
+            version = self._new_version()
+        if self.__class__._cache.get('version') != version:
+            self.__class__._cache = self._load(version)
+        return self.__class__._cache
+
+    def _load(self, version):
+        categories = dict([(category.pk, category) for category in self.all()])
+        data = {
+            'version': version,
+            'by_code': {},
+            'segments': {},
+            'segment_lists': dict([(pk, []) for pk in categories]),
+        }
+        for category in categories.values():
+            data['by_code'][category.code] = category
+        from reviews.models import CategorySegment
+        for segment in CategorySegment.objects.order_by('position', 'pk'):
+            segment._category_cache = categories[segment.category_id]
+            data['segments'][segment.pk] = segment
+            data['segment_lists'][segment.category_id].append(segment)
+        return data
+
+    def _new_version(self):
+        version = repr(time.time())
+        cache.set(CATEGORY_CACHE_VERSION_KEY, version)
+        return version
+
+    def get_by_code(self, code):
+        """
+        Returns the category with the given code from the cache. Raises
+        Category.DoesNotExist like get().
+        """
+        try:
+            return self._get_cache()['by_code'][code]
+        except KeyError:
+            raise self.model.DoesNotExist("Category matching code %r does not exist." % code)
+
+    def get_segments(self, category):
+        """
+        Returns the segments of a category (instance or code) ordered by
+        position.
+        """
+        if not isinstance(category, self.model):
+            category = self.get_by_code(category)
+        return list(self._get_cache()['segment_lists'].get(category.pk, []))
+
+    def get_segment(self, pk):
+        """
+        Returns the category segment with the given primary key from the cache.
+        """
+        from reviews.models import CategorySegment
+        try:
+            return self._get_cache()['segments'][int(pk)]
+        except (KeyError, ValueError, TypeError):
+            raise CategorySegment.DoesNotExist("CategorySegment matching pk %r does not exist." % pk)
+
+    def clear_cache(self):
+        """
+        Drops the cache of this process and, through the version in the django
+        cache, of all other processes.
+        """
+        self._new_version()
+        self.__class__._cache = {}
 
 class ReviewManager(models.Manager):
 
     def in_moderation(self):
         """
-        QuerySet for all reviews currently in the moderation queue.
+        QuerySet for all reviews currently in the moderation queue, oldest
+        first. Served by the (is_public, is_removed, submit_date) index.
+        """
+        return self.get_query_set().filter(is_public=False, is_removed=False) \
+            .order_by('submit_date')
+
+    def most_flagged(self):
+        """
+        QuerySet of the reviews with removal suggestions that are not
+        removed, the most flagged first. Served by the (removal_suggestions,
+        submit_date) index.
+        """
+        return self.get_query_set().filter(is_removed=False, removal_suggestions__gt=0) \
+            .order_by('-removal_suggestions', '-submit_date')
+
+    def approve(self, queryset, user, request=None, batch_size=1000):
+        """
+        Makes the reviews of ``queryset`` public and not removed and resets
+        their removal suggestion counters, see moderate().
+        """
+        from reviews.models import ReviewFlag
+        return self.moderate(queryset, user, ReviewFlag.MODERATOR_APPROVAL,
+                             {'is_public': True, 'is_removed': False,
+                              'removal_suggestions': 0},
+                             request, batch_size)
+
+    def remove(self, queryset, user, request=None, batch_size=1000):
+        """
+        Marks the reviews of ``queryset`` as removed, see moderate().
         """
-        return self.get_query_set().filter(is_public=False, is_removed=False)
+        from reviews.models import ReviewFlag
+        return self.moderate(queryset, user, ReviewFlag.MODERATOR_DELETION,
+                             {'is_removed': True}, request, batch_size)
+
+    def moderate(self, queryset, user, flag, values, request=None, batch_size=1000):
+        """
+        Sets ``values`` on the reviews of ``queryset`` and records the
+        moderation ``flag`` of ``user``, in primary key batches of
+        ``batch_size`` reviews with one transaction each: one UPDATE for the
+        reviews, one insert for the flags the reviews don't have yet, and one
+        summary rebuild per reviewed object. reviews_were_flagged is sent
+        once per batch after it was committed, review_was_flagged isn't sent.
+        Returns the number of moderated reviews.
+        """
+        from reviews.bulk import rebuild_summaries
+        from reviews.models import ReviewFlag
+        from reviews.signals import reviews_were_flagged
+
+        model = queryset.model
+        moderated = 0
+        last_pk = None
+        while True:
+            batch_qs = queryset.order_by('pk')
+            if last_pk is not None:
+                batch_qs = batch_qs.filter(pk__gt=last_pk)
+            with transaction.commit_on_success(using=queryset.db):
+                rows = list(batch_qs.values_list('pk', 'content_type', 'object_pk',
+                                                 'site', 'category')[:batch_size])
+                if not rows:
+                    return moderated
+                pks = [row[0] for row in rows]
+                last_pk = pks[-1]
+
+                model._default_manager.using(queryset.db).filter(pk__in=pks).update(**values)
+                flags = ReviewFlag.objects.db_manager(queryset.db).add_flags(pks, user, flag)
+                rebuild_summaries([row[1:] for row in rows])
+
+            moderated += len(pks)
+            reviews_were_flagged.send(
+                sender  = model,
+                reviews = model._default_manager.using(queryset.db).filter(pk__in=pks),
+                flag    = flag,
+                flags   = flags,
+                request = request
+            )
 
     def for_model(self, model):
         """
@@ -18,5 +281,913 @@ class ReviewManager(models.Manager):
         ct = ContentType.objects.get_for_model(model)
         qs = self.get_query_set().filter(content_type=ct)
         if isinstance(model, models.Model):
-            qs = qs.filter(object_pk=force_unicode(model._get_pk_val()))
+            qs = filter_object(qs, model.__class__, model._get_pk_val())
+        return qs
+
+    def prefetch(self, object_list, limit=3, site_id=None):
+        """
+        Loads the newest ``limit`` visible reviews of every object in
+        ``object_list`` and attaches them to the object as
+        ``latest_reviews``. The review list tags reuse them for the first page
+        of the object. Returns the lists as dict by object.
+
+        The ids of the reviews are selected per content type with one UNION of
+        a LIMITed index scan per object, so the number of rows read stays
+        bounded however many reviews an object has. The reviews themselves
+        are loaded with one more query per SEGMENT_CHUNK_SIZE reviews, see
+        load_reviews().
+        """
+        from reviews.pagination import get_ordering, load_reviews, SEGMENT_CHUNK_SIZE
+        if site_id is None:
+            site_id = settings.SITE_ID
+        limit = int(limit)
+        ordering = get_ordering('newest')
+
+        base = self.get_query_set().filter(site__pk=site_id, is_public=True)
+        if getattr(settings, 'REVIEWS_HIDE_REMOVED', True):
+            base = base.filter(is_removed=False)
+
+        by_ctype = {}
+        for obj in object_list:
+            if obj._get_pk_val() is not None:
+                by_ctype.setdefault(ContentType.objects.get_for_model(obj), []).append(obj)
+
+        review_lists = {}
+        cursor = connections[self.db].cursor()
+        for ctype, objects in by_ctype.items():
+            ctype_qs = base.filter(content_type=ctype)
+            for start in range(0, len(objects), REVIEWS_PREFETCH_CHUNK_SIZE):
+                parts, params = [], []
+                for obj in objects[start:start + REVIEWS_PREFETCH_CHUNK_SIZE]:
+                    # one review more than needed tells whether there is a next page
+                    qs = filter_object(ctype_qs, obj.__class__, obj._get_pk_val())
+                    qs = qs.order_by(*ordering).values_list('pk', flat=True)[:limit + 1]
+                    sql, qs_params = qs.query.get_compiler(using=self.db).as_sql()
+                    parts.append("SELECT * FROM (%s) r%d" % (sql, len(parts)))
+                    params.extend(qs_params)
+                cursor.execute(" UNION ALL ".join(parts), params)
+                review_pks = [row[0] for row in cursor.fetchall()]
+
+                # loaded in chunks, so the pk list stays below the query
+                # parameter limit of SQLite
+                for first in range(0, len(review_pks), SEGMENT_CHUNK_SIZE):
+                    qs = self.get_query_set().filter(
+                        pk__in=review_pks[first:first + SEGMENT_CHUNK_SIZE])
+                    for review in load_reviews(qs):
+                        key = (review.content_type_id, force_unicode(review.object_pk))
+                        review_lists.setdefault(key, []).append(review)
+
+        result = {}
+        for ctype, objects in by_ctype.items():
+            for obj in objects:
+                review_list = review_lists.get((ctype.pk, force_unicode(obj._get_pk_val())), [])
+                review_list.sort(key=lambda review: (review.submit_date, review.pk),
+                                 reverse=True)
+                obj._prefetched_reviews = (site_id, limit, review_list)
+                obj.latest_reviews = result[obj] = review_list[:limit]
+        return result
+
+    def get_stats(self, object_list, category=None, site_id=None):
+        """
+        Returns the review count and average rating of every object in
+        ``object_list`` as dict of unsaved review summaries by object, and
+        attaches the summary to each object as ``review_stats``. One query per
+        content type, see get_stats_for_pks().
+        """
+        by_ctype = {}
+        for obj in object_list:
+            if obj._get_pk_val() is not None:
+                by_ctype.setdefault(ContentType.objects.get_for_model(obj), []).append(obj)
+
+        stats = {}
+        for ctype, objects in by_ctype.items():
+            object_pks = [force_unicode(obj._get_pk_val()) for obj in objects]
+            summaries = self.get_stats_for_pks(ctype, object_pks, category, site_id)
+            for obj, object_pk in zip(objects, object_pks):
+                obj.review_stats = stats[obj] = summaries[object_pk]
+        return stats
+
+    def get_stats_for_pks(self, ctype, object_pks, category=None, site_id=None):
+        """
+        Returns the summaries of the objects of one content type as dict by
+        object_pk, with an empty summary for objects without reviews.
+
+        Reads the stored summaries for Review models, otherwise groups the
+        visible reviews; either way one query.
+        """
+        from reviews.models import Review, ReviewSummary
+        if site_id is None:
+            site_id = settings.SITE_ID
+        object_pks = [force_unicode(object_pk) for object_pk in object_pks]
+
+        rows = {}
+        if issubclass(self.model, Review):
+            qs = ReviewSummary.objects.filter(content_type=ctype, site__pk=site_id,
+                    object_hash__in=[get_object_hash(pk) for pk in object_pks])
+            if category:
+                qs = qs.filter(category__code=category)
+            for summary in qs:
+                rows.setdefault(summary.object_pk, []).append(summary)
+        else:
+            qs = self.get_query_set().filter(content_type=ctype, site__pk=site_id,
+                                             object_pk__in=object_pks, is_public=True)
+            if getattr(settings, 'REVIEWS_HIDE_REMOVED', True):
+                qs = qs.filter(is_removed=False)
+            if category:
+                qs = qs.filter(category__code=category)
+            for row in qs.values('object_pk').annotate(review_count=Count('pk'),
+                    rating_sum=Sum('rating'), rating_min=Min('rating'),
+                    rating_max=Max('rating'), last_review_date=Max('submit_date')):
+                rows.setdefault(row.pop('object_pk'), []).append(ReviewSummary(**row))
+
+        return dict([(object_pk, ReviewSummary.objects.combine(rows.get(object_pk, [])))
+                     for object_pk in object_pks])
+
+class ReviewFlagManager(models.Manager):
+
+    def add_flags(self, review_pks, user, flag):
+        """
+        Adds ``flag`` by ``user`` to the reviews with the given primary keys
+        that don't have it yet, with one query for the existing flags and one
+        insert. Returns the added flags, which may not get their primary keys.
+        """
+        from reviews.bulk import bulk_insert
+        existing = set(self.get_query_set().filter(
+            review__in=review_pks, user=user, flag=flag
+        ).values_list('review', flat=True))
+        now = datetime.datetime.now()
+        flags = [self.model(review_id=pk, user=user, flag=flag, flag_date=now)
+                 for pk in review_pks if pk not in existing]
+        bulk_insert(flags, using=self.db)
+        if flags and flag == self.model.SUGGEST_REMOVAL:
+            self.count_removal_suggestions([f.review_id for f in flags])
+        return flags
+
+    def count_removal_suggestions(self, review_pks, delta=1):
+        """
+        Adds ``delta`` to the removal suggestion counters of the reviews with
+        the given primary keys, with one UPDATE. Reviews that reach
+        REVIEWS_FLAG_HIDE_THRESHOLD are made non-public, which puts them into
+        the moderation queue, and their summaries are rebuilt. Returns the
+        primary keys of the hidden reviews.
+        """
+        from reviews.bulk import rebuild_summaries
+        from reviews.models import Review
+
+        review_qs = Review.objects.db_manager(self.db).filter(pk__in=review_pks)
+        if delta < 0:
+            review_qs = review_qs.filter(removal_suggestions__gt=0)
+        review_qs.update(removal_suggestions=F('removal_suggestions') + delta)
+        if not REVIEWS_FLAG_HIDE_THRESHOLD or delta <= 0:
+            return []
+
+        rows = list(review_qs.filter(
+            is_public=True, is_removed=False,
+            removal_suggestions__gte=REVIEWS_FLAG_HIDE_THRESHOLD
+        ).values_list('pk', 'content_type', 'object_pk', 'site', 'category'))
+        if rows:
+            Review.objects.db_manager(self.db).filter(
+                pk__in=[row[0] for row in rows]).update(is_public=False)
+            rebuild_summaries([row[1:] for row in rows])
+        return [row[0] for row in rows]
+
+class ReviewSummaryManager(models.Manager):
+    """
+    Maintains the ReviewSummary counters. Changes are applied with single
+    UPDATE statements on the counter columns, so concurrent posts for the same
+    object do not lose increments.
+    """
+
+    def is_visible(self, is_public, is_removed):
+        """
+        Whether a review with the given moderation state is shown (and thus
+        counted) by the template tags.
+        """
+        if not is_public:
+            return False
+        if getattr(settings, 'REVIEWS_HIDE_REMOVED', True) and is_removed:
+            return False
+        return True
+
+    def get_visible_reviews(self):
+        """
+        QuerySet of all reviews that are counted in the summaries.
+        """
+        from reviews.models import Review
+        qs = Review.objects.filter(is_public=True)
+        if getattr(settings, 'REVIEWS_HIDE_REMOVED', True):
+            qs = qs.filter(is_removed=False)
         return qs
+
+    def get_for_object(self, obj, category=None, site_id=None):
+        """
+        Returns the summary of the reviews of ``obj``. If no category code is
+        given, the rows of all categories are combined. Always returns a
+        summary, unsaved and empty if there are no reviews.
+        """
+        if site_id is None:
+            site_id = settings.SITE_ID
+        qs = self.get_query_set().filter(
+            content_type = ContentType.objects.get_for_model(obj),
+            object_hash  = get_object_hash(obj._get_pk_val()),
+            site__pk     = site_id,
+        )
+        if category:
+            qs = qs.filter(category__code=category)
+        return self.combine(qs)
+
+    def combine(self, summaries):
+        """
+        Folds several summaries into one (unsaved) summary.
+        """
+        summaries = list(summaries)
+        if len(summaries) == 1:
+            return summaries[0]
+
+        combined = self.model(review_count=0, rating_sum=0)
+        for summary in summaries:
+            combined.review_count += summary.review_count
+            combined.rating_sum += summary.rating_sum
+            for attr, pick in (('rating_min', min), ('rating_max', max),
+                               ('last_review_date', max)):
+                values = [v for v in (getattr(combined, attr),
+                                      getattr(summary, attr)) if v is not None]
+                setattr(combined, attr, values and pick(values) or None)
+        return combined
+
+    def from_queryset(self, qs):
+        """
+        Builds an unsaved summary by aggregating a review queryset. Used for
+        custom review models that are not covered by the stored summaries.
+        """
+        result = qs.aggregate(
+            review_count     = Count('pk'),
+            rating_sum       = Sum('rating'),
+            rating_min       = Min('rating'),
+            rating_max       = Max('rating'),
+            last_review_date = Max('submit_date'),
+        )
+        result['rating_sum'] = result['rating_sum'] or 0
+        return self.model(**result)
+
+    def update_for_review(self, old_state, new_state):
+        """
+        Applies a review change to the summaries. The states are the dicts
+        returned by Review.get_summary_state(); ``old_state`` is None if the
+        previous state is unknown, ``new_state`` is None for deleted reviews.
+        """
+        if old_state is None:
+            if new_state is not None:
+                self.rebuild(self.key(new_state))
+            return
+
+        if new_state is not None and old_state == new_state:
+            return
+
+        if old_state['visible']:
+            self._remove(old_state)
+        if new_state is not None and new_state['visible']:
+            self._add(new_state)
+
+    def rebuild(self, key):
+        """
+        Recalculates the summary for one (content_type_id, object_pk, site_id,
+        category_id) key from the review table.
+        """
+        content_type_id, object_pk, site_id, category_id = key
+        self.clear_prior_means(category_id, site_id)
+        qs = self.get_visible_reviews().filter(
+            content_type__pk = content_type_id,
+            site__pk         = site_id,
+            category__pk     = category_id,
+        )
+        qs = filter_object(qs, ContentType.objects.get_for_id(
+            content_type_id).model_class(), object_pk)
+        values = self.from_queryset(qs)
+        summary = self._get_row(key)
+        qs = self.get_query_set().filter(pk=summary.pk)
+        qs.update(
+            review_count     = values.review_count,
+            rating_sum       = values.rating_sum,
+            rating_min       = values.rating_min,
+            rating_max       = values.rating_max,
+            last_review_date = values.last_review_date,
+        )
+        self._update_score(qs, category_id, site_id)
+
+    def rebuild_all(self):
+        """
+        Recalculates all summaries with one grouped query over the review
+        table. Meant for the initial fill and for repairs, not for requests.
+        """
+        self.get_query_set().all().delete()
+        self.clear_prior_means()
+        rows = self.get_visible_reviews().values(
+            'content_type', 'object_pk', 'site', 'category'
+        ).annotate(
+            review_count     = Count('pk'),
+            rating_sum       = Sum('rating'),
+            rating_min       = Min('rating'),
+            rating_max       = Max('rating'),
+            last_review_date = Max('submit_date'),
+        ).order_by()
+        for row in rows:
+            self.create(
+                content_type_id  = row['content_type'],
+                object_pk        = row['object_pk'],
+                site_id          = row['site'],
+                category_id      = row['category'],
+                review_count     = row['review_count'],
+                rating_sum       = row['rating_sum'],
+                rating_min       = row['rating_min'],
+                rating_max       = row['rating_max'],
+                last_review_date = row['last_review_date'],
+            )
+        self.update_scores()
+
+    def get_prior_mean(self, category_id, site_id):
+        """
+        The average rating of all reviews of a category, the prior of the
+        bayesian toplist score.
+        """
+        return self._get_prior(category_id, site_id)[0]
+
+    def clear_prior_means(self, category_id=None, site_id=None):
+        """
+        Drops the cached prior of one category and site, or of all categories.
+        """
+        if category_id is None:
+            cache.set(PRIOR_CACHE_VERSION_KEY, '%f' % time.time(), None)
+        else:
+            cache.delete(self._get_prior_key(category_id, site_id))
+
+    def _get_prior_key(self, category_id, site_id):
+        version = cache.get(PRIOR_CACHE_VERSION_KEY) or '0'
+        return 'reviews.toplist.mean.%s.%s.%s' % (version, site_id, category_id)
+
+    def _get_prior(self, category_id, site_id):
+        """
+        Returns the prior mean of a category and whether it is stable. Stable
+        priors (of categories with REVIEWS_TOPLIST_PRIOR_MIN_REVIEWS reviews)
+        hardly move and are cached; update_scores() refreshes them.
+        """
+        cache_key = self._get_prior_key(category_id, site_id)
+        mean = cache.get(cache_key)
+        if mean is not None:
+            return mean, True
+        mean, review_count = self._calculate_prior_mean(category_id, site_id)
+        stable = review_count >= REVIEWS_TOPLIST_PRIOR_MIN_REVIEWS
+        if stable:
+            cache.set(cache_key, mean, REVIEWS_TOPLIST_PRIOR_TIMEOUT)
+        return mean, stable
+
+    def update_scores(self, category_id=None):
+        """
+        Recalculates the prior means and the toplist scores of all summaries
+        (of one category), one UPDATE per category and site. The scores are
+        kept up to date incrementally; run this now and then (see the
+        update_review_toplist command) to follow the drift of the means.
+        """
+        groups = self.get_query_set().values('category', 'site').distinct().order_by()
+        if category_id is not None:
+            groups = groups.filter(category__pk=category_id)
+        for group in list(groups):
+            mean, review_count = self._calculate_prior_mean(group['category'], group['site'])
+            cache_key = self._get_prior_key(group['category'], group['site'])
+            if review_count >= REVIEWS_TOPLIST_PRIOR_MIN_REVIEWS:
+                cache.set(cache_key, mean, REVIEWS_TOPLIST_PRIOR_TIMEOUT)
+            else:
+                cache.delete(cache_key)
+            qs = self.get_query_set().filter(category__pk=group['category'],
+                                             site__pk=group['site'])
+            self._update_score(qs, group['category'], group['site'], mean)
+
+    def get_toplist(self, category=None, content_type=None, limit=10, site_id=None):
+        """
+        Returns the ``limit`` best ranked summaries of a category (code) and/or
+        content type. The reviewed objects are loaded with one query per
+        content type and set as ``content_object`` of the summaries.
+        """
+        if site_id is None:
+            site_id = settings.SITE_ID
+        qs = self.get_query_set().filter(site__pk=site_id, review_count__gt=0)
+        if category:
+            qs = qs.filter(category__code=category)
+        if content_type is not None:
+            qs = qs.filter(content_type=content_type)
+        toplist = list(qs.order_by('-score')[:int(limit)])
+
+        pks = {}
+        for summary in toplist:
+            pks.setdefault(summary.content_type_id, []).append(summary.object_pk)
+        objects = {}
+        for content_type_id, object_pks in pks.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            for pk, obj in model._default_manager.in_bulk(object_pks).items():
+                objects[(content_type_id, force_unicode(pk))] = obj
+        for summary in toplist:
+            summary.content_object = objects.get((summary.content_type_id,
+                                                  summary.object_pk))
+        return [summary for summary in toplist if summary.content_object is not None]
+
+    def _calculate_prior_mean(self, category_id, site_id):
+        """
+        Returns the mean rating and the number of reviews of a category.
+        """
+        totals = self.get_query_set().filter(
+            category__pk=category_id, site__pk=site_id
+        ).aggregate(review_count=Sum('review_count'), rating_sum=Sum('rating_sum'))
+        if not totals['review_count']:
+            # no reviews yet, use the middle of the rating scale
+            return (getattr(settings, 'REVIEW_MIN_RATING', 1) +
+                    getattr(settings, 'REVIEW_MAX_RATING', 5)) / 2.0, 0
+        return float(totals['rating_sum']) / totals['review_count'], totals['review_count']
+
+    def _update_score(self, qs, category_id, site_id, mean=None):
+        """
+        Sets the bayesian average (C * m + sum) / (C + n) as score, computed by
+        the database from the stored counters. While the prior of the
+        category isn't stable, all summaries of the category are scored.
+        """
+        if mean is None:
+            mean, stable = self._get_prior(category_id, site_id)
+            if not stable:
+                qs = self.get_query_set().filter(category__pk=category_id,
+                                                 site__pk=site_id)
+        weight = REVIEWS_TOPLIST_PRIOR_WEIGHT
+        qs.update(score=(F('rating_sum') + float(weight) * mean) /
+                        (F('review_count') + weight))
+
+    @staticmethod
+    def key(state):
+        """
+        The (content_type_id, object_pk, site_id, category_id) summary key of
+        a review state.
+        """
+        return (state['content_type_id'], state['object_pk'],
+                state['site_id'], state['category_id'])
+
+    def _get_row(self, key):
+        content_type_id, object_pk, site_id, category_id = key
+        summary, created = self.get_or_create(
+            content_type__pk = content_type_id,
+            object_hash      = get_object_hash(object_pk),
+            site__pk         = site_id,
+            category__pk     = category_id,
+            defaults         = dict(
+                content_type_id = content_type_id,
+                object_pk       = object_pk,
+                site_id         = site_id,
+                category_id     = category_id,
+            )
+        )
+        return summary
+
+    def _add(self, state):
+        rating = int(state['rating'])
+        date = state['submit_date']
+        summary = self._get_row(self.key(state))
+        qs = self.get_query_set().filter(pk=summary.pk)
+
+        qs.update(review_count=F('review_count') + 1,
+                  rating_sum=F('rating_sum') + rating)
+        qs.filter(Q(rating_min__isnull=True) | Q(rating_min__gt=rating)) \
+            .update(rating_min=rating)
+        qs.filter(Q(rating_max__isnull=True) | Q(rating_max__lt=rating)) \
+            .update(rating_max=rating)
+        if date is not None:
+            qs.filter(Q(last_review_date__isnull=True) | Q(last_review_date__lt=date)) \
+                .update(last_review_date=date)
+        self._update_score(qs, state['category_id'], state['site_id'])
+
+    def _remove(self, state):
+        rating = int(state['rating'])
+        key = self.key(state)
+        summary = self._get_row(key)
+
+        # the extremes can't be decremented; if the removed review defined one
+        # of them, recalculate the row (rare, moderation only)
+        if summary.review_count <= 1 or \
+           summary.rating_min == rating or summary.rating_max == rating or \
+           summary.last_review_date == state['submit_date']:
+            self.rebuild(key)
+            return
+
+        qs = self.get_query_set().filter(pk=summary.pk)
+        qs.update(review_count=F('review_count') - 1,
+                  rating_sum=F('rating_sum') - rating)
+        self._update_score(qs, state['category_id'], state['site_id'])
+
+class SegmentSummaryManager(models.Manager):
+    """
+    Maintains the SegmentSummary counters. Like the ReviewSummaryManager,
+    changes are applied with single UPDATE statements.
+    """
+
+    def get_for_object(self, obj, category, site_id=None):
+        """
+        Returns the summaries of the segments of ``obj`` for the category with
+        the given code, ordered like the segments in the review form.
+        Segments without any rating have no summary.
+        """
+        if site_id is None:
+            site_id = settings.SITE_ID
+        return self.get_query_set().filter(
+            content_type          = ContentType.objects.get_for_model(obj),
+            object_hash           = get_object_hash(obj._get_pk_val()),
+            site__pk              = site_id,
+            segment__category__code = category,
+        ).select_related('segment').order_by('segment__position')
+
+    def get_for_pks(self, ctype, object_pks, category=None, site_id=None):
+        """
+        Returns the segment summaries of many objects of one content type with
+        one query, as dict of lists (ordered like the segments in the review
+        form) by object_pk.
+        """
+        if site_id is None:
+            site_id = settings.SITE_ID
+        object_pks = [force_unicode(object_pk) for object_pk in object_pks]
+        qs = self.get_query_set().filter(content_type=ctype, site__pk=site_id,
+                object_hash__in=[get_object_hash(pk) for pk in object_pks])
+        if category:
+            qs = qs.filter(segment__category__code=category)
+
+        summaries = dict([(object_pk, []) for object_pk in object_pks])
+        for summary in qs.select_related('segment').order_by('segment__position'):
+            summaries[summary.object_pk].append(summary)
+        return summaries
+
+    def update_for_review(self, review, old_state, new_state):
+        """
+        Applies a change of a review (see ReviewSummaryManager) to the
+        summaries of its segments.
+        """
+        if old_state is None:
+            self.rebuild(ReviewSummaryManager.key(new_state))
+            return
+
+        old_visible = old_state['visible']
+        new_visible = new_state['visible']
+        if old_visible == new_visible and \
+           ReviewSummaryManager.key(old_state) == ReviewSummaryManager.key(new_state):
+            return
+        if not old_visible and not new_visible:
+            return
+
+        segments = review.segments.values_list('segment', 'rating')
+        for segment_id, rating in segments:
+            if old_visible:
+                self._change(old_state, segment_id, rating, -1)
+            if new_visible:
+                self._change(new_state, segment_id, rating, 1)
+
+    def update_for_segment(self, review, old_state, new_state):
+        """
+        Applies a change of a single segment of ``review``. The states are the
+        dicts returned by ReviewSegment.get_summary_state(). Segments only
+        count while their review is visible.
+        """
+        review_state = review._summary_state
+        if review_state is None:
+            self.rebuild(ReviewSummaryManager.key(review.get_summary_state()))
+            return
+        if not review_state['visible'] or old_state == new_state:
+            return
+
+        if old_state is None:
+            self.rebuild(ReviewSummaryManager.key(review_state))
+            return
+
+        if old_state['saved']:
+            self._change(review_state, old_state['segment_id'],
+                         old_state['rating'], -1)
+        self._change(review_state, new_state['segment_id'],
+                     new_state['rating'], 1)
+
+    def rebuild(self, key):
+        """
+        Recalculates all segment summaries of the object of a review summary
+        key (the category is ignored), with one grouped query over the segment
+        table.
+        """
+        from reviews.models import ReviewSegment
+        content_type_id, object_pk, site_id = key[:3]
+
+        filters = dict(
+            review__content_type__pk = content_type_id,
+            review__site__pk         = site_id,
+            review__is_public        = True,
+        )
+        if getattr(settings, 'REVIEWS_HIDE_REMOVED', True):
+            filters['review__is_removed'] = False
+        qs = filter_object(ReviewSegment.objects.filter(**filters),
+            ContentType.objects.get_for_id(content_type_id).model_class(),
+            object_pk, prefix='review__')
+        rows = qs.values(
+            'segment', 'rating'
+        ).annotate(review_count=Count('pk')).order_by()
+
+        values = {}
+        for row in rows:
+            counters = values.setdefault(row['segment'], self._empty_counters())
+            counters['review_count'] += row['review_count']
+            counters['rating_sum'] += row['rating'] * row['review_count']
+            if row['rating'] in self.model.HISTOGRAM_RATINGS:
+                counters['rating_%s' % row['rating']] += row['review_count']
+
+        existing = self.get_query_set().filter(
+            content_type__pk = content_type_id,
+            object_hash      = get_object_hash(object_pk),
+            site__pk         = site_id,
+        )
+        existing.exclude(segment__in=values.keys()).update(**self._empty_counters())
+        for segment_id, counters in values.items():
+            summary = self._get_row((content_type_id, object_pk, site_id), segment_id)
+            self.get_query_set().filter(pk=summary.pk).update(**counters)
+
+    def rebuild_all(self):
+        """
+        Recalculates the segment summaries of all objects that have a review
+        summary, see ReviewSummaryManager.rebuild_all().
+        """
+        from reviews.models import ReviewSummary
+        self.get_query_set().all().delete()
+        keys = ReviewSummary.objects.values_list('content_type', 'object_pk',
+                                                 'site').distinct()
+        for key in keys:
+            self.rebuild(key)
+
+    def _empty_counters(self):
+        counters = dict(review_count=0, rating_sum=0)
+        for rating in self.model.HISTOGRAM_RATINGS:
+            counters['rating_%s' % rating] = 0
+        return counters
+
+    def _get_row(self, object_key, segment_id):
+        content_type_id, object_pk, site_id = object_key
+        summary, created = self.get_or_create(
+            content_type__pk = content_type_id,
+            object_hash      = get_object_hash(object_pk),
+            site__pk         = site_id,
+            segment__pk      = segment_id,
+            defaults         = dict(
+                content_type_id = content_type_id,
+                object_pk       = object_pk,
+                site_id         = site_id,
+                segment_id      = segment_id,
+            )
+        )
+        return summary
+
+    def _change(self, review_state, segment_id, rating, delta):
+        rating = int(rating)
+        content_type_id, object_pk, site_id, category_id = \
+            ReviewSummaryManager.key(review_state)
+        summary = self._get_row((content_type_id, object_pk, site_id), segment_id)
+
+        counters = dict(
+            review_count = F('review_count') + delta,
+            rating_sum   = F('rating_sum') + delta * rating,
+        )
+        if rating in self.model.HISTOGRAM_RATINGS:
+            column = 'rating_%s' % rating
+            counters[column] = F(column) + delta
+        self.get_query_set().filter(pk=summary.pk).update(**counters)
+
+class ArchivedReviewManager(models.Manager):
+    """
+    Moves reviews (with segments and flags) from the review tables into the
+    compressed archive and back.
+    """
+
+    def get_archivable(self, removed=True, older_than=None):
+        """
+        QuerySet of the reviews to archive: removed reviews (if ``removed``)
+        and reviews submitted before ``older_than`` (a datetime).
+        """
+        import reviews
+        condition = Q()
+        if removed:
+            condition |= Q(is_removed=True)
+        if older_than is not None:
+            condition |= Q(submit_date__lt=older_than)
+        model = reviews.get_model()
+        if not condition:
+            return model._default_manager.none()
+        return model._default_manager.filter(condition)
+
+    def archive(self, qs, batch_size=1000):
+        """
+        Archives the reviews of ``qs`` in batches of ``batch_size``, each in
+        its own transaction. Returns the number of archived reviews.
+        """
+        archived = 0
+        last_pk = None
+        while True:
+            batch_qs = qs.order_by('pk')
+            if last_pk is not None:
+                # rows the batch couldn't archive must not come up again
+                batch_qs = batch_qs.filter(pk__gt=last_pk)
+            pks = list(batch_qs.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return archived
+            last_pk = pks[-1]
+            archived += self.archive_batch(qs.model, pks)
+
+    @transaction.commit_on_success
+    def archive_batch(self, model, pks):
+        """
+        Archives the reviews of ``model`` with the given primary keys: writes
+        the archive rows, deletes the reviews and rebuilds the summaries of
+        the reviewed objects once.
+        """
+        from reviews.bulk import bulk_insert, rebuild_summaries, suspend_summaries
+        from reviews.export import iter_records, parse_date
+        from reviews.models import Category, ReviewFlag
+
+        categories = dict(Category.objects.values_list('code', 'pk'))
+
+        flags = {}
+        for row in ReviewFlag.objects.filter(review__in=pks).values(
+                'review', 'user', 'flag', 'flag_date'):
+            review_pk = row.pop('review')
+            row['flag_date'] = row['flag_date'].isoformat(' ')
+            flags.setdefault(review_pk, []).append(row)
+
+        qs = model._default_manager.filter(pk__in=pks)
+        archive = []
+        keys = []
+        for record in iter_records(qs):
+            record['flags'] = flags.get(record['id'], [])
+            archived = self.model(
+                review_id    = record['id'],
+                content_type = ContentType.objects.get_by_natural_key(
+                                   *record['content_type'].split('.', 1)),
+                object_pk    = record['object_pk'],
+                site_id      = record['site'],
+                category_id  = categories[record['category']],
+                rating       = record['rating'],
+                submit_date  = parse_date(record['submit_date']),
+                is_public    = record['is_public'],
+                is_removed   = record['is_removed'],
+            )
+            archived.record = record
+            archive.append(archived)
+            keys.append((archived.content_type_id, archived.object_pk,
+                         archived.site_id, archived.category_id))
+        bulk_insert(archive)
+
+        with suspend_summaries():
+            qs.delete()
+        rebuild_summaries(keys)
+        return len(archive)
+
+    @transaction.commit_on_success
+    def restore(self, archived_qs):
+        """
+        Moves archived reviews back into the review tables, with their
+        original ids, segments and flags.
+
+        Databases that reuse ids (SQLite, MySQL after a restart) may have
+        given the id of an archived review to a new one. Such reviews are not
+        restored and stay in the archive. Returns the number of restored
+        reviews and the list of the review ids that are taken.
+        """
+        from reviews.bulk import bulk_insert, update_summaries
+        from reviews.export import RecordLoader, parse_date
+        from reviews.models import Review, ReviewFlag
+
+        archived_list = list(archived_qs)
+        taken = set(Review._base_manager.filter(
+            pk__in=[archived.review_id for archived in archived_list]
+        ).values_list('pk', flat=True))
+        archived_list = [archived for archived in archived_list
+                         if archived.review_id not in taken]
+
+        loader = RecordLoader(keep_pk=True)
+        review_list = []
+        segment_list = []
+        flag_list = []
+        for archived in archived_list:
+            record = archived.record
+            review, segments = loader.build(record)
+            review_list.append(review)
+            for segment in segments:
+                segment.review_id = review.pk
+                segment_list.append(segment)
+            for flag in record.get('flags', []):
+                flag_list.append(ReviewFlag(review_id=review.pk, user_id=flag['user'],
+                                            flag=flag['flag'],
+                                            flag_date=parse_date(flag['flag_date'])))
+
+        bulk_insert(review_list, set_pks=True)
+        bulk_insert(segment_list)
+        bulk_insert(flag_list)
+        self.get_query_set().filter(pk__in=[a.pk for a in archived_list]).delete()
+        update_summaries(review_list)
+        return len(review_list), sorted(taken)
+
+class ReviewSpoolManager(models.Manager):
+    """
+    Writes review submissions into the spool and saves them as reviews in
+    batches, see SpooledReview.
+    """
+
+    def spool(self, review, segments):
+        """
+        Adds an unsaved review with its unsaved segments to the spool. Raises
+        IntegrityError if a submission with the same idempotency key is
+        spooled already.
+        """
+        from reviews.export import get_record
+        spooled = self.model(idempotency_key=review.idempotency_key or None)
+        spooled.record = get_record(review, segments)
+        with transaction.commit_on_success(using=self.db):
+            spooled.save(using=self.db)
+        return spooled
+
+    def process(self, batch_size=100, max_attempts=5):
+        """
+        Saves the oldest ``batch_size`` spooled reviews in one transaction:
+        every review with its segments (one bulk insert) in a savepoint of
+        its own, the summaries once for the batch. review_will_be_posted and
+        review_was_posted are sent for every review, without request.
+
+        Submissions that can't be loaded (e.g. their category was deleted) or
+        saved, or whose review_will_be_posted receiver raises, stay in the
+        spool with the error until they failed ``max_attempts`` times; the
+        rest of the batch is saved anyway. Returns the numbers of saved,
+        discarded (duplicates and reviews killed by a review_will_be_posted
+        receiver) and failed submissions.
+        """
+        import reviews
+        from reviews import signals
+        from reviews.bulk import bulk_insert, suspend_summaries, update_summaries
+        from reviews.export import RecordLoader
+
+        rows = list(self.get_query_set().filter(attempts__lt=max_attempts)
+                    .order_by('pk')[:batch_size])
+        if not rows:
+            return 0, 0, 0
+
+        model = reviews.get_model()
+        existing = set(model._default_manager.filter(
+            idempotency_key__in=[row.idempotency_key for row in rows if row.idempotency_key]
+        ).values_list('idempotency_key', flat=True))
+
+        loader = RecordLoader()
+        batch, done, failed = [], [], []
+        for row in rows:
+            if row.idempotency_key and row.idempotency_key in existing:
+                done.append(row.pk)
+                continue
+            try:
+                review, segments = loader.build(row.record)
+                review.idempotency_key = row.idempotency_key
+                responses = signals.review_will_be_posted.send(
+                    sender   = review.__class__,
+                    review   = review,
+                    segments = segments,
+                    request  = None
+                )
+            except Exception, e:
+                # a bad record or receiver must not block the spool
+                failed.append((row, e))
+                continue
+            if False in [response for (receiver, response) in responses]:
+                done.append(row.pk)
+                continue
+            batch.append((row, review, segments))
+
+        saved = []
+        with transaction.commit_on_success(using=self.db):
+            with suspend_summaries():
+                for row, review, segments in batch:
+                    sid = transaction.savepoint(using=self.db)
+                    try:
+                        review.save(using=self.db)
+                        for segment in segments:
+                            segment.review = review
+                        bulk_insert(segments, using=self.db)
+                    except Exception, e:
+                        transaction.savepoint_rollback(sid, using=self.db)
+                        failed.append((row, e))
+                        continue
+                    transaction.savepoint_commit(sid, using=self.db)
+                    done.append(row.pk)
+                    saved.append(review)
+            update_summaries(saved)
+            self.get_query_set().filter(pk__in=done).delete()
+
+        for row, error in failed:
+            self.get_query_set().filter(pk=row.pk).update(
+                attempts=F('attempts') + 1, last_error=force_unicode(error))
+
+        for review in saved:
+            signals.review_was_posted.send(
+                sender  = review.__class__,
+                review  = review,
+                request = None
+            )
+        return len(saved), len(done) - len(saved), len(failed)
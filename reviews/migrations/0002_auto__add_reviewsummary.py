@@ -0,0 +1,145 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'ReviewSummary'
+        db.create_table('reviews_reviewsummary', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(related_name='review_summaries', to=orm['contenttypes.ContentType'])),
+            ('object_pk', self.gf('django.db.models.fields.CharField')(max_length=2000)),
+            ('object_hash', self.gf('django.db.models.fields.CharField')(max_length=40)),
+            ('site', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['sites.Site'])),
+            ('category', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['reviews.Category'])),
+            ('review_count', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('rating_sum', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('rating_min', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('rating_max', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('last_review_date', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('reviews', ['ReviewSummary'])
+
+        # Adding unique constraint on 'ReviewSummary', fields ['content_type', 'object_hash', 'site', 'category']
+        db.create_unique('reviews_reviewsummary', ['content_type_id', 'object_hash', 'site_id', 'category_id'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'ReviewSummary', fields ['content_type', 'object_hash', 'site', 'category']
+        db.delete_unique('reviews_reviewsummary', ['content_type_id', 'object_hash', 'site_id', 'category_id'])
+
+        # Deleting model 'ReviewSummary'
+        db.delete_table('reviews_reviewsummary')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'reviews.category': {
+            'Meta': {'object_name': 'Category'},
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '200'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'reviews.categorysegment': {
+            'Meta': {'object_name': 'CategorySegment'},
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['reviews.Category']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'position': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'reviews.review': {
+            'Meta': {'ordering': "('submit_date',)", 'object_name': 'Review'},
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['reviews.Category']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'content_type_set_for_review'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('django.db.models.fields.IPAddressField', [], {'max_length': '15', 'null': 'True', 'blank': 'True'}),
+            'is_public': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_removed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'object_pk': ('django.db.models.fields.CharField', [], {'max_length': '2000'}),
+            'rating': ('django.db.models.fields.IntegerField', [], {}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"}),
+            'submit_date': ('django.db.models.fields.DateTimeField', [], {'default': 'None'}),
+            'text': ('django.db.models.fields.TextField', [], {'max_length': '3000'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'review_reviews'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'user_email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'user_name': ('django.db.models.fields.CharField', [], {'max_length': '50', 'blank': 'True'})
+        },
+        'reviews.reviewflag': {
+            'Meta': {'unique_together': "[('user', 'review', 'flag')]", 'object_name': 'ReviewFlag'},
+            'flag': ('django.db.models.fields.CharField', [], {'max_length': '30', 'db_index': 'True'}),
+            'flag_date': ('django.db.models.fields.DateTimeField', [], {'default': 'None'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'review': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'flags'", 'to': "orm['reviews.Review']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'review_flags'", 'to': "orm['auth.User']"})
+        },
+        'reviews.reviewsegment': {
+            'Meta': {'object_name': 'ReviewSegment'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'rating': ('django.db.models.fields.IntegerField', [], {}),
+            'review': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'segments'", 'to': "orm['reviews.Review']"}),
+            'segment': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['reviews.CategorySegment']"}),
+            'text': ('django.db.models.fields.TextField', [], {'max_length': '3000'})
+        },
+        'reviews.reviewsummary': {
+            'Meta': {'unique_together': "[('content_type', 'object_hash', 'site', 'category')]", 'object_name': 'ReviewSummary'},
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['reviews.Category']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'review_summaries'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_review_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'object_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'object_pk': ('django.db.models.fields.CharField', [], {'max_length': '2000'}),
+            'rating_max': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rating_min': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'rating_sum': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'review_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"})
+        },
+        'sites.site': {
+            'Meta': {'ordering': "('domain',)", 'object_name': 'Site', 'db_table': "'django_site'"},
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['reviews']
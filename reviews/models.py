@@ -1,4 +1,6 @@
+import base64
 import datetime
+import zlib
 from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
@@ -7,7 +9,15 @@ from django.db import models
 from django.core import urlresolvers
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
-from reviews.managers import ReviewManager
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.utils import simplejson
+from django.utils.hashcompat import sha_constructor
+from reviews.managers import CategoryManager, ReviewManager, ReviewFlagManager, \
+    ReviewSummaryManager, SegmentSummaryManager, ArchivedReviewManager, \
+    ReviewSpoolManager, get_object_id, get_object_hash
+from reviews.bulk import summaries_suspended
+from reviews.fragments import bump_object_version
+from reviews.signals import review_was_posted, review_was_flagged
 
 REVIEW_MAX_LENGTH = getattr(settings,'REVIEW_MAX_LENGTH',3000)
 
@@ -21,6 +31,8 @@ class Category(models.Model):
     """
     code = models.CharField(_('category code'), max_length = 200, unique = True)
 
+    objects = CategoryManager()
+
     class Meta:
         verbose_name = _('category')
         verbose_name_plural = _('categories')
@@ -28,6 +40,12 @@ class Category(models.Model):
     def __unicode__(self):
         return self.code
 
+    def get_segments(self):
+        """
+        Returns the (cached) segments of this category ordered by position.
+        """
+        return Category.objects.get_segments(self)
+
 class CategorySegment(models.Model):
     """
     A single segment in a category.
@@ -48,6 +66,24 @@ class CategorySegment(models.Model):
     def __unicode__(self):
         return self.title
 
+def categories_changed(sender, **kwargs):
+    """
+    Invalidates the category cache of all processes.
+    """
+    Category.objects.clear_cache()
+
+def category_deleted(sender, instance, **kwargs):
+    """
+    Drops the cached toplist prior of a deleted category.
+    """
+    ReviewSummary.objects.clear_prior_means()
+
+post_save.connect(categories_changed, sender=Category)
+post_delete.connect(categories_changed, sender=Category)
+post_save.connect(categories_changed, sender=CategorySegment)
+post_delete.connect(category_deleted, sender=Category)
+post_delete.connect(categories_changed, sender=CategorySegment)
+
 class BaseReviewAbstractModel(models.Model):
     """
     An abstract base class that any custom review models probably should
@@ -61,6 +97,14 @@ class BaseReviewAbstractModel(models.Model):
     object_pk      = models.CharField(_('object ID'), max_length=2000)
     content_object = generic.GenericForeignKey(ct_field="content_type", fk_field="object_pk")
 
+    # Integer copy of object_pk, filled before every save (see
+    # fill_object_id) if the reviewed model has an integer primary key.
+    # Lookups use it (and its indexes) instead of the wide object_pk string
+    # whenever possible. The composite lookup index is created by the
+    # migrations (see 0008_review_lookup_indexes).
+    object_id      = models.IntegerField(_('object ID (integer)'), blank=True,
+                        null=True, editable=False)
+
     # Metadata about the review
     site        = models.ForeignKey(Site)
 
@@ -76,6 +120,19 @@ class BaseReviewAbstractModel(models.Model):
             args=(self.content_type_id, self.object_pk)
         )
 
+def fill_object_id(sender, instance, **kwargs):
+    """
+    Fills object_id before a review is saved. Connected to all models, as
+    pre_save is also sent for raw saves (e.g. by loaddata) of every table of
+    a custom review model.
+    """
+    if isinstance(instance, BaseReviewAbstractModel) and instance.content_type_id:
+        instance.object_id = get_object_id(
+            ContentType.objects.get_for_id(instance.content_type_id).model_class(),
+            instance.object_pk)
+
+pre_save.connect(fill_object_id)
+
 class Review(BaseReviewAbstractModel):
     """
     A user wrote a review about some object.
@@ -96,7 +153,8 @@ class Review(BaseReviewAbstractModel):
     category   = models.ForeignKey(Category, verbose_name=_('review category'))
 
     # Metadata about the review
-    submit_date = models.DateTimeField(_('date/time submitted'), default=None)
+    submit_date = models.DateTimeField(_('date/time submitted'), default=None,
+                    db_index=True)
     ip_address  = models.IPAddressField(_('IP address'), blank=True, null=True)
     is_public   = models.BooleanField(_('is public'), default=True,
                     help_text=_('Uncheck this box to make the review effectively ' \
@@ -106,6 +164,20 @@ class Review(BaseReviewAbstractModel):
                                 'A "This review has been removed" message will ' \
                                 'be displayed instead.'))
 
+    # Duplicate detection: a hash of the normalized review (see
+    # get_content_hash()) and the key of the form submission that created the
+    # review. A second submission of the same form can't insert another row.
+    content_hash    = models.CharField(_('content hash'), max_length=40,
+                        blank=True, db_index=True, editable=False)
+    idempotency_key = models.CharField(_('idempotency key'), max_length=40,
+                        blank=True, null=True, unique=True, editable=False)
+
+    # The number of "removal suggestion" flags of the review since it was last
+    # approved, maintained by ReviewFlag.objects.count_removal_suggestions().
+    # Reviews reaching REVIEWS_FLAG_HIDE_THRESHOLD are hidden for moderation.
+    removal_suggestions = models.IntegerField(_('removal suggestions'), default=0,
+                            editable=False)
+
     # Manager
     objects = ReviewManager()
 
@@ -115,13 +187,70 @@ class Review(BaseReviewAbstractModel):
         verbose_name = _('review')
         verbose_name_plural = _('reviews')
 
+    def __init__(self, *args, **kwargs):
+        super(Review, self).__init__(*args, **kwargs)
+        self._summary_state = self.get_summary_state(load_deferred=False)
+
     def __unicode__(self):
         return "%s: %s..." % (self.user_name, self.text [:50])
 
     def save(self, *args, **kwargs):
         if self.submit_date is None:
             self.submit_date = datetime.datetime.now()
+        self.content_hash = self.get_content_hash()
         super(Review, self).save(*args, **kwargs)
+        if summaries_suspended():
+            return
+
+        # keep the denormalized summaries in sync with the review
+        old = self._summary_state
+        state = self.get_summary_state()
+        ReviewSummary.objects.update_for_review(old, state)
+        SegmentSummary.objects.update_for_review(self, old, state)
+
+        # invalidate the cached review lists of the object (and of the old
+        # object if the review was moved), after the summaries the change
+        # time is stored in were created
+        bump_object_version(self.content_type_id, self.object_pk)
+        if old and (old['content_type_id'], old['object_pk']) != \
+                (self.content_type_id, self.object_pk):
+            bump_object_version(old['content_type_id'], old['object_pk'])
+        self._summary_state = state
+
+    def get_content_hash(self):
+        """
+        Returns a hash of the object, author, day and text of the review. Case
+        and whitespace of the text are ignored, so a review posted twice on the
+        same day has the same hash.
+        """
+        submit_date = self.submit_date or datetime.datetime.now()
+        value = u"\n".join([
+            unicode(self.content_type_id),
+            unicode(self.object_pk),
+            (self.user_name or u'').strip().lower(),
+            (self.user_email or u'').strip().lower(),
+            submit_date.date().isoformat(),
+            u" ".join((self.text or u'').lower().split()),
+        ])
+        return sha_constructor(value.encode('utf-8')).hexdigest()
+
+    def get_summary_state(self, load_deferred=True):
+        """
+        Returns a snapshot of the fields the ReviewSummary counters depend on.
+
+        Unsaved reviews are never counted. If load_deferred is False and one
+        of the fields is deferred, None is returned instead of loading it; the
+        summary is then rebuilt instead of being updated incrementally.
+        """
+        if not load_deferred:
+            for attname in ReviewSummary.REVIEW_FIELDS:
+                if attname not in self.__dict__:
+                    return None
+        state = dict([(attname, getattr(self, attname))
+                      for attname in ReviewSummary.REVIEW_FIELDS])
+        state['visible'] = self.pk is not None and \
+            ReviewSummary.objects.is_visible(state['is_public'], state['is_removed'])
+        return state
 
     def _get_userinfo(self):
         """
@@ -160,6 +289,17 @@ class Review(BaseReviewAbstractModel):
         self.user_email = val
     email = property(_get_email, _set_email, doc="The email of the user who posted this review")
 
+    def get_segments(self):
+        """
+        Returns the segments of this review in form order. Review lists load
+        the segments of a whole page at once and attach them; otherwise they
+        are queried here.
+        """
+        if not hasattr(self, "_segment_list"):
+            self._segment_list = list(self.segments.select_related('segment')
+                                      .order_by('segment__position', 'pk'))
+        return self._segment_list
+
     @models.permalink
     def get_absolute_url(self):
         return ('reviews-review-detail', self.id)
@@ -200,6 +340,8 @@ class ReviewFlag(models.Model):
     MODERATOR_DELETION = "moderator deletion"
     MODERATOR_APPROVAL = "moderator approval"
 
+    objects = ReviewFlagManager()
+
     class Meta:
         unique_together = [('user', 'review', 'flag')]
         verbose_name = _('review flag')
@@ -228,3 +370,324 @@ class ReviewSegment(models.Model):
     class Meta:
         verbose_name = _('review segment')
         verbose_name_plural = _('review segments')
+
+    def __init__(self, *args, **kwargs):
+        super(ReviewSegment, self).__init__(*args, **kwargs)
+        self._summary_state = self.get_summary_state(load_deferred=False)
+
+    def save(self, *args, **kwargs):
+        super(ReviewSegment, self).save(*args, **kwargs)
+        if summaries_suspended():
+            return
+
+        review = self.review
+        bump_object_version(review.content_type_id, review.object_pk)
+
+        # keep the denormalized segment summaries in sync with the segment
+        state = self.get_summary_state()
+        SegmentSummary.objects.update_for_segment(self.review,
+                                                  self._summary_state, state)
+        self._summary_state = state
+
+    def get_summary_state(self, load_deferred=True):
+        """
+        Returns a snapshot of the fields the SegmentSummary counters depend on,
+        see Review.get_summary_state().
+        """
+        if not load_deferred:
+            for attname in SegmentSummary.SEGMENT_FIELDS:
+                if attname not in self.__dict__:
+                    return None
+        state = dict([(attname, getattr(self, attname))
+                      for attname in SegmentSummary.SEGMENT_FIELDS])
+        state['saved'] = self.pk is not None
+        return state
+
+
+class ReviewSummary(models.Model):
+    """
+    Denormalized counters over the visible reviews of one object in one
+    category.
+
+    The rows are maintained incrementally by Review.save() and on deletion, so
+    the count and rating template tags read a single indexed row instead of
+    aggregating the review table on every page view. Indexed by score, the
+    table is also the ranking the review toplists are served from.
+    """
+    content_type     = models.ForeignKey(ContentType, verbose_name=_('content type'),
+                         related_name="review_summaries")
+    object_pk        = models.CharField(_('object ID'), max_length=2000)
+    # the summaries are looked up by the hash of object_pk, the key can be
+    # longer than an index allows
+    object_hash      = models.CharField(_('object ID hash'), max_length=40,
+                         editable=False)
+    site             = models.ForeignKey(Site)
+    category         = models.ForeignKey(Category, verbose_name=_('review category'))
+
+    review_count     = models.IntegerField(_('review count'), default=0)
+    rating_sum       = models.IntegerField(_('rating sum'), default=0)
+    rating_min       = models.IntegerField(_('lowest rating'), blank=True, null=True)
+    rating_max       = models.IntegerField(_('highest rating'), blank=True, null=True)
+    last_review_date = models.DateTimeField(_('last review'), blank=True, null=True)
+    # the last change of a review of the object, see reviews.fragments
+    last_change      = models.DateTimeField(_('last change'), default=datetime.datetime.now,
+                         editable=False)
+
+    # bayesian average of the ratings, the rank in the review toplists
+    score            = models.FloatField(_('toplist score'), default=0)
+
+    objects = ReviewSummaryManager()
+
+    # Review attributes the counters depend on
+    REVIEW_FIELDS = ('content_type_id', 'object_pk', 'site_id', 'category_id',
+                     'rating', 'submit_date', 'is_public', 'is_removed')
+
+    class Meta:
+        unique_together = [('content_type', 'object_hash', 'site', 'category')]
+        verbose_name = _('review summary')
+        verbose_name_plural = _('review summaries')
+
+    def save(self, *args, **kwargs):
+        self.object_hash = get_object_hash(self.object_pk)
+        super(ReviewSummary, self).save(*args, **kwargs)
+
+    def __unicode__(self):
+        return "%s reviews of %s %s" % \
+            (self.review_count, self.content_type_id, self.object_pk)
+
+    def _get_rating_average(self):
+        """
+        The average rating of the summarized reviews, None if there are none.
+        """
+        if not self.review_count:
+            return None
+        return float(self.rating_sum) / self.review_count
+    rating_average = property(_get_rating_average, doc=_get_rating_average.__doc__)
+
+def review_deleted(sender, instance, **kwargs):
+    """
+    Removes a deleted review from its summaries. Only connected to Review
+    itself: deleting a custom review subclass deletes (and signals) the parent
+    row too.
+    """
+    if summaries_suspended():
+        return
+    bump_object_version(instance.content_type_id, instance.object_pk)
+    state = instance._summary_state
+    if state is None:
+        return
+    ReviewSummary.objects.update_for_review(state, None)
+    if state['visible']:
+        SegmentSummary.objects.rebuild(ReviewSummary.objects.key(state))
+
+post_delete.connect(review_deleted, sender=Review)
+
+def review_posted_or_flagged(sender, review, **kwargs):
+    """
+    Invalidates the cached review lists of the object of a posted or flagged
+    review.
+    """
+    bump_object_version(review.content_type_id, review.object_pk)
+
+review_was_posted.connect(review_posted_or_flagged)
+review_was_flagged.connect(review_posted_or_flagged)
+
+def flag_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Counts a new removal suggestion of a review. A review instance the flag
+    was created with gets the new counter (and visibility) as well, so saving
+    it afterwards doesn't undo the change.
+    """
+    if raw or not created or instance.flag != ReviewFlag.SUGGEST_REMOVAL:
+        return
+    hidden = ReviewFlag.objects.count_removal_suggestions([instance.review_id])
+    review = getattr(instance, '_review_cache', None)
+    if review is not None:
+        review.removal_suggestions += 1
+        if hidden:
+            review.is_public = False
+            review._summary_state = review.get_summary_state()
+
+def flag_deleted(sender, instance, **kwargs):
+    """
+    Uncounts a deleted removal suggestion, except for bulk deletions (e.g. by
+    the archive) which suspend the summaries.
+    """
+    if summaries_suspended() or instance.flag != ReviewFlag.SUGGEST_REMOVAL:
+        return
+    ReviewFlag.objects.count_removal_suggestions([instance.review_id], -1)
+
+post_save.connect(flag_saved, sender=ReviewFlag)
+post_delete.connect(flag_deleted, sender=ReviewFlag)
+
+class SegmentSummary(models.Model):
+    """
+    Denormalized counters and a rating histogram over the segments of the
+    visible reviews of one object, per category segment.
+
+    Maintained by ReviewSegment.save() and Review.save(), so the segment
+    ratings of an object are read from a few indexed rows instead of grouping
+    the segment table joined through the reviews.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'),
+                     related_name="segment_summaries")
+    object_pk    = models.CharField(_('object ID'), max_length=2000)
+    object_hash  = models.CharField(_('object ID hash'), max_length=40,
+                     editable=False)
+    site         = models.ForeignKey(Site)
+    segment      = models.ForeignKey(CategorySegment,
+                     verbose_name=_('review category segment'))
+
+    review_count = models.IntegerField(_('review count'), default=0)
+    rating_sum   = models.IntegerField(_('rating sum'), default=0)
+
+    # the rating histogram, one counter per rating choice
+    rating_1     = models.IntegerField(default=0)
+    rating_2     = models.IntegerField(default=0)
+    rating_3     = models.IntegerField(default=0)
+    rating_4     = models.IntegerField(default=0)
+    rating_5     = models.IntegerField(default=0)
+
+    objects = SegmentSummaryManager()
+
+    # ReviewSegment attributes the counters depend on
+    SEGMENT_FIELDS = ('review_id', 'segment_id', 'rating')
+
+    # ratings that have a histogram column
+    HISTOGRAM_RATINGS = (1, 2, 3, 4, 5)
+
+    class Meta:
+        unique_together = [('content_type', 'object_hash', 'site', 'segment')]
+        verbose_name = _('segment summary')
+        verbose_name_plural = _('segment summaries')
+
+    def save(self, *args, **kwargs):
+        self.object_hash = get_object_hash(self.object_pk)
+        super(SegmentSummary, self).save(*args, **kwargs)
+
+    def __unicode__(self):
+        return "%s ratings of %s %s for segment %s" % \
+            (self.review_count, self.content_type_id, self.object_pk,
+             self.segment_id)
+
+    def _get_rating_average(self):
+        """
+        The average rating of the summarized segments, None if there are none.
+        """
+        if not self.review_count:
+            return None
+        return float(self.rating_sum) / self.review_count
+    rating_average = property(_get_rating_average, doc=_get_rating_average.__doc__)
+
+    def _get_histogram(self):
+        """
+        List of (rating, count) tuples, lowest rating first.
+        """
+        return [(rating, getattr(self, 'rating_%s' % rating))
+                for rating in self.HISTOGRAM_RATINGS]
+    histogram = property(_get_histogram, doc=_get_histogram.__doc__)
+
+def segment_deleted(sender, instance, **kwargs):
+    """
+    Removes a deleted segment from the segment summaries. If the review is
+    deleted as well, review_deleted takes care of it.
+    """
+    if summaries_suspended():
+        return
+    try:
+        review = Review.objects.get(pk=instance.review_id)
+    except Review.DoesNotExist:
+        return
+    bump_object_version(review.content_type_id, review.object_pk)
+    state = review.get_summary_state()
+    if state['visible']:
+        SegmentSummary.objects.rebuild(ReviewSummary.objects.key(state))
+
+post_delete.connect(segment_deleted, sender=ReviewSegment)
+
+class ArchivedReview(models.Model):
+    """
+    A review moved out of the review tables by the archive_reviews command,
+    because it was removed or is older than the retention window.
+
+    The full review, with segments and flags, is stored as compressed record
+    (the format of reviews.export); the columns needed to find archived
+    reviews are kept uncompressed. ArchivedReview.objects.restore() moves
+    reviews back.
+    """
+    review_id    = models.IntegerField(_('review ID'), db_index=True)
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'),
+                     related_name="archived_reviews")
+    object_pk    = models.CharField(_('object ID'), max_length=2000)
+    site         = models.ForeignKey(Site)
+    category     = models.ForeignKey(Category, verbose_name=_('review category'))
+    rating       = models.IntegerField(_('rating'))
+    submit_date  = models.DateTimeField(_('date/time submitted'))
+    is_public    = models.BooleanField(_('is public'))
+    is_removed   = models.BooleanField(_('is removed'))
+    archive_date = models.DateTimeField(_('date/time archived'), default=datetime.datetime.now)
+
+    # zlib compressed, base64 encoded JSON record of the review
+    data         = models.TextField(_('data'))
+
+    objects = ArchivedReviewManager()
+
+    class Meta:
+        ordering = ('-archive_date',)
+        verbose_name = _('archived review')
+        verbose_name_plural = _('archived reviews')
+
+    def __unicode__(self):
+        return "%s: %s..." % (self.record.get('user_name'),
+                              (self.record.get('text') or '')[:50])
+
+    def _get_record(self):
+        """
+        The archived review as dict, with "segments" and "flags" lists.
+        """
+        if not hasattr(self, "_record"):
+            self._record = simplejson.loads(zlib.decompress(base64.b64decode(self.data)))
+        return self._record
+    def _set_record(self, record):
+        self._record = record
+        self.data = base64.b64encode(zlib.compress(simplejson.dumps(record), 9))
+    record = property(_get_record, _set_record, doc=_get_record.__doc__)
+
+class SpooledReview(models.Model):
+    """
+    A validated review submission waiting to be saved. With REVIEWS_SPOOL
+    the post_review view only writes these rows; the process_review_spool
+    command saves the reviews in batches.
+
+    The review with its segments is stored as JSON record in the format of
+    reviews.export.
+    """
+    idempotency_key = models.CharField(_('idempotency key'), max_length=40,
+                        blank=True, null=True, unique=True)
+    spool_date      = models.DateTimeField(_('date/time spooled'), default=datetime.datetime.now)
+    attempts        = models.IntegerField(_('failed attempts'), default=0)
+    last_error      = models.TextField(_('last error'), blank=True)
+    data            = models.TextField(_('data'))
+
+    objects = ReviewSpoolManager()
+
+    class Meta:
+        ordering = ('spool_date',)
+        verbose_name = _('spooled review')
+        verbose_name_plural = _('spooled reviews')
+
+    def __unicode__(self):
+        return "%s: %s..." % (self.record.get('user_name'),
+                              (self.record.get('text') or '')[:50])
+
+    def _get_record(self):
+        """
+        The spooled review as dict, with a "segments" list.
+        """
+        if not hasattr(self, "_record"):
+            self._record = simplejson.loads(self.data)
+        return self._record
+    def _set_record(self, record):
+        self._record = record
+        self.data = simplejson.dumps(record)
+    record = property(_get_record, _set_record, doc=_get_record.__doc__)
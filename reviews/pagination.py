@@ -0,0 +1,263 @@
+"""
+Keyset (cursor) pagination for review lists.
+
+Instead of OFFSET, a page continues after the sort key of the last review of
+the previous page. The key always ends with (submit_date, id), so it is
+unique, and every page is a range scan on the review lookup indexes: deep
+pages cost the same as the first one.
+
+The cursor is the url-safe string returned as ``next_cursor`` of a page, e.g.
+"20110514093012000000_42" or, for the rating orders, "5_20110514093012000000_42".
+
+EstimatedCountPaginator is for the admin, which pages with OFFSET: it takes
+the row count of unfiltered review tables from the database statistics
+instead of counting millions of rows.
+"""
+import datetime
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+import reviews
+
+REVIEWS_PAGE_SIZE = getattr(settings, 'REVIEWS_PAGE_SIZE', 20)
+
+# the sort orders a list can be requested in. All columns of an order are
+# sorted in the same direction, so one index serves both directions.
+ORDERINGS = {
+    'newest'  : ('-submit_date', '-id'),
+    'oldest'  : ('submit_date', 'id'),
+    'highest' : ('-rating', '-submit_date', '-id'),
+    'lowest'  : ('rating', 'submit_date', 'id'),
+}
+DEFAULT_ORDERING = 'newest'
+
+DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+class ReviewPage(object):
+    """
+    One page of reviews. Iterates over the reviews of the page, so it can be
+    used wherever the review queryset was used before.
+    """
+
+    def __init__(self, object_list, order, next_cursor=None):
+        self.object_list = object_list
+        self.order = order
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __nonzero__(self):
+        return bool(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+def load_reviews(qs):
+    """
+    Loads the reviews of ``qs`` for display: users and categories are joined
+    into the review query, the segments of all reviews (with their category
+    segments) are loaded with one more query. A page thus costs two queries,
+    however many reviews and segments it has.
+    """
+    review_list = list(qs.select_related('user', 'category'))
+    return attach_segments(review_list)
+
+# the number of reviews (or of their segments) loaded with one query, below
+# the 999 query parameters of SQLite
+SEGMENT_CHUNK_SIZE = 500
+
+def attach_segments(review_list):
+    """
+    Loads the segments of the given reviews with one query per
+    SEGMENT_CHUNK_SIZE reviews and attaches them, see Review.get_segments().
+    """
+    if not review_list:
+        return review_list
+    segments = {}
+    review_pks = [review.pk for review in review_list]
+    for start in range(0, len(review_pks), SEGMENT_CHUNK_SIZE):
+        qs = reviews.get_segment_model()._default_manager.filter(
+            review__in=review_pks[start:start + SEGMENT_CHUNK_SIZE]
+        ).select_related('segment').order_by('segment__position', 'pk')
+        for segment in qs:
+            segments.setdefault(segment.review_id, []).append(segment)
+
+    for review in review_list:
+        review._segment_list = segments.get(review.pk, [])
+        for segment in review._segment_list:
+            segment._review_cache = review
+    return review_list
+
+def attach_content_objects(review_list):
+    """
+    Loads the reviewed objects of the given reviews with one query per
+    content type and sets them as their content_object. Objects that don't
+    exist any more become None instead of being queried again.
+    """
+    object_pks = {}
+    for review in review_list:
+        object_pks.setdefault(review.content_type_id, set()).add(review.object_pk)
+
+    objects = {}
+    for content_type_id, pks in object_pks.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+        for pk, obj in model._default_manager.in_bulk(list(pks)).items():
+            objects[(content_type_id, unicode(pk))] = obj
+
+    for review in review_list:
+        review._content_object_cache = objects.get(
+            (review.content_type_id, unicode(review.object_pk)))
+    return review_list
+
+def get_ordering(order):
+    """
+    Returns the order_by() fields for an order name; unknown names give the
+    default order.
+    """
+    return ORDERINGS.get(order or DEFAULT_ORDERING, ORDERINGS[DEFAULT_ORDERING])
+
+def encode_cursor(review, ordering):
+    """
+    Returns the cursor pointing behind ``review`` in the given ordering.
+    """
+    values = []
+    for field in ordering:
+        value = getattr(review, field.lstrip('-'))
+        if isinstance(value, datetime.datetime):
+            value = value.strftime(DATE_FORMAT)
+        values.append(str(value))
+    return '_'.join(values)
+
+def decode_cursor(cursor, ordering):
+    """
+    Reverse of encode_cursor(). Returns the list of key values, or None if the
+    cursor is malformed or belongs to another ordering.
+    """
+    parts = str(cursor).split('_')
+    if len(parts) != len(ordering):
+        return None
+    values = []
+    try:
+        for field, part in zip(ordering, parts):
+            if field.lstrip('-') == 'submit_date':
+                values.append(datetime.datetime.strptime(part, DATE_FORMAT))
+            else:
+                values.append(int(part))
+    except ValueError:
+        return None
+    return values
+
+def filter_after(qs, ordering, values):
+    """
+    Restricts ``qs`` to the rows sorted behind the key ``values``:
+    (a, b, c) > (x, y, z) written as
+    a >= x AND (a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)).
+
+    The redundant a >= x is the range condition the databases start the index
+    scan with; they can't take a range from the OR expansion alone and would
+    read the index from its start instead.
+    """
+    first = ordering[0]
+    bound = first.startswith('-') and '__lte' or '__gte'
+    qs = qs.filter(**{first.lstrip('-') + bound: values[0]})
+
+    condition = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = field.startswith('-') and '__lt' or '__gt'
+        term = Q(**{name + lookup: values[i]})
+        for previous, value in zip(ordering[:i], values[:i]):
+            term &= Q(**{previous.lstrip('-'): value})
+        condition |= term
+    return qs.filter(condition)
+
+def paginate(qs, order=None, limit=None, after=None, offset=None):
+    """
+    Returns the page of ``qs`` in the given order that starts after the
+    cursor ``after``, or the first page. Loads one review more than ``limit``
+    to find out whether there is a next page.
+
+    ``offset`` is only used without a cursor. It is supported for the old
+    "offset" tag argument but costs an OFFSET scan; follow next_cursor instead.
+    """
+    ordering = get_ordering(order)
+    limit = int(limit or REVIEWS_PAGE_SIZE)
+    start = int(offset or 0)
+
+    qs = qs.order_by(*ordering)
+    if after:
+        values = decode_cursor(after, ordering)
+        if values is not None:
+            qs = filter_after(qs, ordering, values)
+            start = 0
+
+    object_list = list(qs.select_related('user', 'category')[start:start + limit + 1])
+    page = get_page(object_list, order, limit)
+    attach_segments(page.object_list)
+    return page
+
+def get_page(object_list, order, limit):
+    """
+    Returns the first ``limit`` reviews of ``object_list`` (sorted in the
+    given order) as page. The list may hold more reviews; if it does, the
+    page has a next cursor.
+    """
+    next_cursor = None
+    if len(object_list) > limit:
+        object_list = object_list[:limit]
+        next_cursor = encode_cursor(object_list[-1], get_ordering(order))
+    return ReviewPage(object_list, order or DEFAULT_ORDERING, next_cursor)
+
+# unfiltered tables with fewer rows than this (by estimate) are counted exactly
+ESTIMATED_COUNT_MINIMUM = 10000
+
+def get_estimated_count(qs):
+    """
+    Returns the number of rows of the table of an unfiltered queryset from the
+    statistics of PostgreSQL or MySQL. None if the queryset is filtered or the
+    database keeps no such statistics.
+    """
+    if qs.query.where or qs.query.having:
+        return None
+    connection = connections[qs.db]
+    vendor = getattr(connection, 'vendor', None)
+    table = qs.model._meta.db_table
+    cursor = connection.cursor()
+    if vendor == 'postgresql':
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [table])
+        row = cursor.fetchone()
+        return row and int(row[0])
+    if vendor == 'mysql':
+        cursor.execute("SHOW TABLE STATUS LIKE %s", [table])
+        row = cursor.fetchone()
+        # the fifth column is "Rows", NULL for some storage engines
+        return row and row[4] is not None and int(row[4]) or None
+    return None
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that estimates the count of large unfiltered tables (see
+    get_estimated_count()) instead of counting every row. Filtered lists and
+    small tables are counted exactly. The estimate may be a bit off, so the
+    last page can be empty or incomplete.
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            estimate = None
+            if hasattr(self.object_list, 'query'):
+                estimate = get_estimated_count(self.object_list)
+            if estimate is not None and estimate >= ESTIMATED_COUNT_MINIMUM:
+                self._count = estimate
+            else:
+                self._count = super(EstimatedCountPaginator, self)._get_count()
+        return self._count
+    count = property(_get_count)
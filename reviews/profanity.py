@@ -0,0 +1,118 @@
+"""
+Fast search for profanities in review texts.
+
+All words of the list are compiled into one regular expression, built from a
+trie of the words: at every position of the text the expression follows the
+characters of the text through the trie instead of trying every word on its
+own. A text is checked in a single pass, whatever the length of the list.
+
+The compiled matcher is kept and only rebuilt when another word list is
+passed, see get_matcher().
+"""
+import re
+import threading
+
+_lock = threading.Lock()
+_matchers = {}
+
+def build_pattern(words):
+    """
+    Returns a regular expression (without flags) that matches any of
+    ``words``. Common prefixes are shared, e.g. "ab", "abc" and "ad" become
+    "a(?:b(?:c)?|d)".
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def pattern(node):
+        branches = [re.escape(char) + pattern(node[char])
+                    for char in sorted(node) if char]
+        if not branches:
+            return ''
+        optional = '' in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        result = '(?:%s)' % '|'.join(branches)
+        if optional:
+            # the longest word wins, the shorter one is a prefix of it
+            result += '?'
+        return result
+
+    return pattern(trie)
+
+class ProfanityMatcher(object):
+    """
+    Finds the words of a list in texts, case insensitive: words and texts are
+    lowercased, which is much faster than an IGNORECASE expression. With
+    ``word_boundaries`` only whole words match ("ass" doesn't match "class"),
+    otherwise any occurrence like the old substring search.
+    """
+
+    def __init__(self, words, word_boundaries=False):
+        self.words = tuple(words)
+        self.word_boundaries = word_boundaries
+        self.lowered = set([word.lower() for word in self.words if word])
+        if not self.lowered:
+            self.regex = None
+            return
+        pattern = build_pattern(self.lowered)
+        if word_boundaries:
+            pattern = r'(?<!\w)%s(?!\w)' % pattern
+        self.regex = re.compile(pattern, re.UNICODE)
+
+    def search(self, text):
+        """
+        Whether ``text`` contains any of the words.
+        """
+        return self.regex is not None and self.regex.search(text.lower()) is not None
+
+    def find_all(self, text):
+        """
+        Returns the distinct words found in ``text``, lowercased, in the
+        order they first appear. Overlapping words are all found: the search
+        is repeated one character after the start of every match, and the
+        words that are prefixes of a match (the expression only matches the
+        longest word at a position) are looked up in the word set.
+        """
+        found = []
+        if self.regex is None:
+            return found
+        text = text.lower()
+        match = self.regex.search(text)
+        while match is not None:
+            word = match.group(0)
+            words = [word]
+            if not self.word_boundaries:
+                words = [word[:end] for end in range(1, len(word))
+                         if word[:end] in self.lowered] + words
+            for word in words:
+                if word not in found:
+                    found.append(word)
+            match = self.regex.search(text, match.start() + 1)
+        return found
+
+def get_matcher(words, word_boundaries=False):
+    """
+    Returns the compiled matcher for a word list. The matcher is cached for
+    the list object itself, so settings.PROFANITIES_LIST is compiled once
+    without comparing its words on every call. A list changed in place
+    isn't noticed, assign a new list instead.
+    """
+    matcher = _matchers.get(word_boundaries)
+    if matcher is not None and matcher.source is words:
+        return matcher
+    _lock.acquire()
+    try:
+        matcher = _matchers.get(word_boundaries)
+        if matcher is None or matcher.source is not words:
+            # only the matcher of the current list is kept
+            matcher = ProfanityMatcher(words, word_boundaries)
+            matcher.source = words
+            _matchers[word_boundaries] = matcher
+        return matcher
+    finally:
+        _lock.release()
@@ -17,5 +17,17 @@ review_was_posted = Signal(providing_args=["review", "segments", "request"])
 
 # Sent after a review was "flagged" in some way. Check the flag to see if this
 # was a user requesting removal of a review, a moderator approving/removing a
-# review, or some other custom user flag.
+# review, or some other custom user flag. Not sent for bulk moderation (which
+# sent it per review before), see reviews_were_flagged.
 review_was_flagged = Signal(providing_args=["review", "flag", "created", "request"])
+
+# Sent once for a batch of reviews that were written in bulk (e.g. by the
+# import_reviews command), instead of review_was_posted for every review.
+reviews_were_posted = Signal(providing_args=["reviews", "request"])
+
+# Sent once for a batch of reviews that were flagged in bulk (e.g. approved or
+# removed by the moderation actions of the admin), instead of
+# review_was_flagged per review. ``reviews`` is a queryset of the batch,
+# ``flags`` the flags that were added. Receivers of review_was_flagged that
+# have to see every moderated review must be connected to this one as well.
+reviews_were_flagged = Signal(providing_args=["reviews", "flag", "flags", "request"])
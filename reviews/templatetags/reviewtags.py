@@ -1,10 +1,15 @@
 from django.conf import settings
 from django import template
 from django.contrib.contenttypes.models import ContentType
-from django.utils.encoding import smart_unicode
-from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.template.loader import select_template
 from classytags.core import Tag, Options
 from classytags.arguments import Argument
+from reviews.fragments import get_fragment_key
+from reviews.managers import get_object_reviews
+from reviews.models import Review, ReviewSummary, SegmentSummary
+from reviews.pagination import paginate, get_page, \
+    REVIEWS_PAGE_SIZE, DEFAULT_ORDERING
 import reviews
 
 """
@@ -14,6 +19,40 @@ because of import problems.
 
 register = template.Library()
 
+# The templates of the render_* tags are searched in a list of locations. The
+# template found for a combination of tag, model, category and explicit
+# template is remembered, so the loaders are asked only once per process. Set
+# REVIEWS_CACHE_TEMPLATES to False to pick up new templates without a restart.
+REVIEWS_CACHE_TEMPLATES = getattr(settings, 'REVIEWS_CACHE_TEMPLATES', not settings.DEBUG)
+
+_template_cache = {}
+
+def get_review_template(key, template_search_list):
+    """
+    Returns the first existing template of ``template_search_list``, cached
+    under ``key``.
+    """
+    if not REVIEWS_CACHE_TEMPLATES:
+        return select_template(template_search_list)
+    try:
+        return _template_cache[key]
+    except KeyError:
+        template = select_template(template_search_list)
+        _template_cache[key] = template
+        return template
+
+def render_review_template(context, key, template_search_list, dictionary):
+    """
+    Renders the template found by get_review_template() with ``dictionary``
+    pushed onto the context.
+    """
+    template = get_review_template(key, template_search_list)
+    context.update(dictionary)
+    try:
+        return template.render(context)
+    finally:
+        context.pop()
+
 class BaseHandler(Tag):
     """
     Base class used by all review template tags. Defines the parameters and
@@ -31,6 +70,11 @@ class BaseHandler(Tag):
         # used in rendering lists
         'offset',   Argument('offset', required=False),
         'limit',    Argument('limit', required=False),
+        'order',    Argument('order', required=False),
+        'after',    Argument('after', required=False),
+
+        # used in render_review_list to cache the output for n seconds
+        'cache',    Argument('cache_timeout', required=False),
 
         # used in render_* to set the template
         'with',     Argument('with', required=False, resolve=False),
@@ -46,26 +90,39 @@ class BaseHandler(Tag):
         if not object_pk:
             return model.objects.none()
 
-        qs = model.objects.filter(
-            content_type = ctype,
-            object_pk    = smart_unicode(object_pk),
-            site__pk     = settings.SITE_ID,
-        )
-
-        # The is_public and is_removed fields are implementation details of the
-        # built-in review model's spam filtering system, so they might not
-        # be present on a custom comment model subclass. If they exist, we
-        # should filter on them.
-        field_names = [f.name for f in model._meta.fields]
-        if 'is_public' in field_names:
-            qs = qs.filter(is_public=True)
-        if getattr(settings, 'REVIEWS_HIDE_REMOVED', True) and 'is_removed' in field_names:
-            qs = qs.filter(is_removed=False)
-
+        qs = get_object_reviews(model, object_expr.__class__, object_pk)
         qs = qs.order_by('-id')
 
         return qs
 
+    def get_review_list(self, qs, kwargs):
+        """
+        Applies the list arguments (order, limit, after, offset) to the review
+        queryset and loads the reviews with their users, categories and
+        segments in a fixed number of queries. Returns a ReviewPage, the first
+        REVIEWS_PAGE_SIZE reviews in the default order without arguments.
+        """
+        page = self.get_prefetched_page(kwargs)
+        if page is not None:
+            return page
+        return paginate(qs, kwargs.get('order'), kwargs.get('limit'),
+                        kwargs.get('after'), kwargs.get('offset'))
+
+    def get_prefetched_page(self, kwargs):
+        """
+        Returns the first page of the object from the reviews loaded by
+        prefetch_reviews, or None if they don't cover the requested page.
+        """
+        prefetched = getattr(kwargs.get('name'), '_prefetched_reviews', None)
+        if prefetched is None or kwargs.get('after') or kwargs.get('offset') or \
+                (kwargs.get('order') or DEFAULT_ORDERING) != 'newest':
+            return None
+        site_id, prefetch_limit, review_list = prefetched
+        limit = int(kwargs.get('limit') or REVIEWS_PAGE_SIZE)
+        if site_id != settings.SITE_ID or limit > prefetch_limit:
+            return None
+        return get_page(review_list, 'newest', limit)
+
     def handle_result(self, context, kwargs, rs):
         """
         if "as" was used, we fill the value into this variable
@@ -90,13 +147,18 @@ class ListHandler(BaseHandler):
 
         ctype = self.get_target_ctype_pk(context, kwargs['name'])
         qs = self.get_query_set(context, reviews.get_model(), ctype, kwargs['name'])
+        review_list = self.get_review_list(qs, kwargs)
 
-        rs = self.render_tag(context, qs)
+        rs = self.render_tag(context, review_list)
         return self.handle_result(context, kwargs, rs)
 
 class RenderListHandler(BaseHandler):
     """
-    Extends BaseHandler by creating the queryset used in all list-based tags
+    Extends BaseHandler by creating the queryset used in all list-based tags.
+    With "cache <seconds>" the rendered list is cached until the timeout or a
+    change of the reviews of the object, see reviews.fragments. The cached
+    list is rendered with an empty context instead of the page context, so
+    nothing of the current request or user can end up in the cache.
     """
 
     def render(self, context):
@@ -105,14 +167,161 @@ class RenderListHandler(BaseHandler):
         kwargs = dict([(key, value.resolve(context)) for key, value in items])
         kwargs.update(self.blocks)
 
+        if not kwargs.get('cache_timeout') or not kwargs['name'].pk:
+            rs = self.render_list(context, kwargs)
+        else:
+            key = get_fragment_key(self.name, kwargs['name'], kwargs['category'],
+                                   [kwargs.get(arg) for arg in
+                                    ('order', 'limit', 'after', 'offset', 'with')])
+            rs = cache.get(key)
+            if rs is None:
+                rs = self.render_list(template.Context(autoescape=context.autoescape),
+                                      kwargs)
+                cache.set(key, rs, int(kwargs['cache_timeout']))
+        return self.handle_result(context, kwargs, rs)
+
+    def render_list(self, context, kwargs):
         ctype = self.get_target_ctype_pk(context, kwargs['name'])
         qs = self.get_query_set(context, reviews.get_model(), ctype, kwargs['name'])
+        review_list = self.get_review_list(qs, kwargs)
 
         template = []
-        if 'with' in kwargs:
+        if kwargs.get('with'):
             template.append(kwargs['with'])
 
-        rs = self.render_tag(context, kwargs['name'], kwargs['category'], qs, template)
+        return self.render_tag(context, kwargs['name'], kwargs['category'], review_list, template)
+
+class SummaryHandler(BaseHandler):
+    """
+    Extends BaseHandler by loading the ReviewSummary of the object. Custom
+    review models that do not extend Review are not covered by the stored
+    summaries, for them the summary is aggregated from the queryset.
+    """
+
+    def render(self, context):
+        # resolv kwargs values
+        items = self.kwargs.items()
+        kwargs = dict([(key, value.resolve(context)) for key, value in items])
+        kwargs.update(self.blocks)
+
+        model = reviews.get_model()
+        if issubclass(model, Review):
+            summary = ReviewSummary.objects.get_for_object(kwargs['name'],
+                            category=kwargs['category'])
+        else:
+            ctype = self.get_target_ctype_pk(context, kwargs['name'])
+            qs = self.get_query_set(context, model, ctype, kwargs['name'])
+            if kwargs['category']:
+                qs = qs.filter(category__code=kwargs['category'])
+            summary = ReviewSummary.objects.from_queryset(qs)
+
+        rs = self.render_tag(context, summary)
+        return self.handle_result(context, kwargs, rs)
+
+class StatsHandler(BaseHandler):
+    """
+    Extends BaseHandler by loading the review counts and averages of a whole
+    list of objects, with one query per content type.
+    """
+
+    options = Options(
+        'for',      Argument('object_list'),
+        'category', Argument('category', required=False),
+        'as',       Argument('varname', required=False, resolve=False)
+    )
+
+    def render(self, context):
+        # resolv kwargs values
+        items = self.kwargs.items()
+        kwargs = dict([(key, value.resolve(context)) for key, value in items])
+        kwargs.update(self.blocks)
+
+        model = reviews.get_model()
+        if issubclass(model, Review):
+            manager = Review.objects
+        else:
+            manager = model._default_manager
+        object_list = list(kwargs['object_list'] or [])
+        if hasattr(manager, 'get_stats'):
+            stats = manager.get_stats(object_list, category=kwargs['category'])
+        else:
+            stats = {}
+            for obj in object_list:
+                qs = self.get_query_set(context, model, None, obj)
+                if kwargs['category']:
+                    qs = qs.filter(category__code=kwargs['category'])
+                obj.review_stats = stats[obj] = ReviewSummary.objects.from_queryset(qs)
+
+        rs = self.render_tag(context, stats)
+        return self.handle_result(context, kwargs, rs)
+
+class PrefetchHandler(BaseHandler):
+    """
+    Extends BaseHandler by loading the newest reviews of a whole list of
+    objects at once.
+    """
+
+    options = Options(
+        'for',      Argument('object_list'),
+        'limit',    Argument('limit', required=False),
+        'as',       Argument('varname', required=False, resolve=False)
+    )
+
+    def render(self, context):
+        # resolv kwargs values
+        items = self.kwargs.items()
+        kwargs = dict([(key, value.resolve(context)) for key, value in items])
+        kwargs.update(self.blocks)
+
+        manager = reviews.get_model()._default_manager
+        object_list = list(kwargs['object_list'] or [])
+        if hasattr(manager, 'prefetch'):
+            result = manager.prefetch(object_list, limit=kwargs['limit'] or 3)
+        else:
+            result = {}
+
+        rs = self.render_tag(context, result)
+        if kwargs.get('varname'):
+            return self.handle_result(context, kwargs, rs)
+        return ''
+
+class ToplistHandler(BaseHandler):
+    """
+    Extends BaseHandler by loading the best ranked objects of a category
+    and/or a content type from the stored review summaries. The content type
+    is given as "app_label.model" string, model class or instance.
+    """
+
+    options = Options(
+        'for',      Argument('model', required=False),
+        'category', Argument('category', required=False),
+        'limit',    Argument('limit', required=False),
+        'with',     Argument('with', required=False, resolve=False),
+        'as',       Argument('varname', required=False, resolve=False)
+    )
+
+    def get_content_type(self, model):
+        if not model:
+            return None
+        if isinstance(model, basestring):
+            return ContentType.objects.get_by_natural_key(*model.split('.', 1))
+        return ContentType.objects.get_for_model(model)
+
+    def render(self, context):
+        # resolv kwargs values
+        items = self.kwargs.items()
+        kwargs = dict([(key, value.resolve(context)) for key, value in items])
+        kwargs.update(self.blocks)
+
+        ctype = self.get_content_type(kwargs['model'])
+        toplist = ReviewSummary.objects.get_toplist(category=kwargs['category'],
+                        content_type=ctype, limit=kwargs['limit'] or 10)
+
+        template = []
+        if kwargs.get('with'):
+            template.append(kwargs['with'])
+
+        rs = self.render_tag(context, ctype, kwargs['category'], toplist, template)
         return self.handle_result(context, kwargs, rs)
 
 class EntryHandler(BaseHandler):
@@ -135,7 +344,7 @@ class RenderEntryHandler(BaseHandler):
         kwargs.update(self.blocks)
 
         template = []
-        if 'with' in kwargs:
+        if kwargs.get('with'):
             template.append(kwargs['with'])
 
         rs = self.render_tag(context, kwargs['name'], kwargs['category'], template)
@@ -145,15 +354,48 @@ class RenderEntryHandler(BaseHandler):
 # ----------------------------------------
 
 
-class GetReviewCount(ListHandler):
+class GetReviewCount(SummaryHandler):
     """
     Counts the reviews for one object.
     """
 
     name = 'get_review_count'
 
-    def render_tag(self, context, qs):
-        return qs.count()
+    def render_tag(self, context, summary):
+        return summary.review_count
+
+class GetReviewAverage(SummaryHandler):
+    """
+    returns the average rating of the reviews for one object, or None if it
+    has no reviews
+    """
+
+    name = 'get_review_average'
+
+    def render_tag(self, context, summary):
+        return summary.rating_average
+
+class GetReviewStats(StatsHandler):
+    """
+    returns the review summaries (review_count, rating_average) of a list of
+    objects by object, and attaches them to the objects as ``review_stats``
+    """
+
+    name = 'get_review_stats'
+
+    def render_tag(self, context, stats):
+        return stats
+
+class PrefetchReviews(PrefetchHandler):
+    """
+    loads the newest reviews of every object of a list and attaches them as
+    ``latest_reviews``; get_review_list and render_review_list reuse them
+    """
+
+    name = 'prefetch_reviews'
+
+    def render_tag(self, context, result):
+        return result
 
 class GetReviewList(ListHandler):
     """
@@ -162,8 +404,19 @@ class GetReviewList(ListHandler):
 
     name = 'get_review_list'
 
-    def render_tag(self, context, qs):
-        return qs.all()
+    def render_tag(self, context, review_list):
+        return review_list
+
+class GetSegmentRatings(EntryHandler):
+    """
+    returns the segment summaries (count, average and rating histogram per
+    category segment) of an object
+    """
+
+    name = 'get_segment_ratings'
+
+    def render_tag(self, context, object_expr, category):
+        return SegmentSummary.objects.get_for_object(object_expr, category)
 
 class GetReviewtForm(EntryHandler):
     """
@@ -184,10 +437,12 @@ class RenderReviewForm(RenderEntryHandler):
     name = 'render_review_form'
 
 
-    def render_tag(self, context, object_expr, category, template_search_list = []):
+    def render_tag(self, context, object_expr, category, template_search_list):
         ctype, object_pk = self.get_target_ctype_pk(context, object_expr)
         if object_pk:
-            template_search_list.extend([
+            key = (self.name, ctype.app_label, ctype.model, category,
+                   tuple(template_search_list))
+            template_search_list = template_search_list + [
                 # classic comments like
                 "reviews/%s/%s/form.html" % (ctype.app_label, ctype.model),
                 "reviews/%s/form.html" % ctype.app_label,
@@ -198,13 +453,10 @@ class RenderReviewForm(RenderEntryHandler):
                 "reviews/form_%s.html" % category,
 
                 "reviews/form.html"
-            ])
-            context.push()
-            formstr = render_to_string(template_search_list, {
+            ]
+            return render_review_template(context, key, template_search_list, {
                     "form" : reviews.get_form()(object_expr, category=category)
-                }, context)
-            context.pop()
-            return formstr
+                })
         else:
             return ''
 
@@ -215,11 +467,13 @@ class RenderReviewList(RenderListHandler):
 
     name = 'render_review_list'
 
-    def render_tag(self, context, object_expr, category, qs, template_search_list = [], offset = None, limit = None):
+    def render_tag(self, context, object_expr, category, review_list, template_search_list):
         ctype, object_pk = self.get_target_ctype_pk(context, object_expr)
-        template_search_list.extend([
+        key = (self.name, ctype.app_label, ctype.model, category,
+               tuple(template_search_list))
+        template_search_list = template_search_list + [
             # classic comments like
-            "reviews/%s/%s/folistrm.html" % (ctype.app_label, ctype.model),
+            "reviews/%s/%s/list.html" % (ctype.app_label, ctype.model),
             "reviews/%s/list.html" % ctype.app_label,
 
             # like before, but with optional different template per category
@@ -228,16 +482,50 @@ class RenderReviewList(RenderListHandler):
             "reviews/list_%s.html" % category,
 
             "reviews/list.html"
-        ])
+        ]
 
-        context.push()
-        liststr = render_to_string(template_search_list, {
+        return render_review_template(context, key, template_search_list, {
                     "object": object_expr,
                     "category": category,
-                    "review_list" : qs.all()
-                  }, context)
-        context.pop()
-        return liststr
+                    "review_list" : review_list,
+                    "next_cursor" : getattr(review_list, 'next_cursor', None),
+                  })
+
+class GetReviewToplist(ToplistHandler):
+    """
+    returns the best ranked reviewed objects as list of review summaries,
+    the objects are available as ``content_object``
+    """
+
+    name = 'get_review_toplist'
+
+    def render_tag(self, context, ctype, category, toplist, template_search_list):
+        return toplist
+
+class RenderReviewToplist(ToplistHandler):
+    """
+    renders the best ranked reviewed objects, looks for different locations of
+    the toplist html file
+    """
+
+    name = 'render_review_toplist'
+
+    def render_tag(self, context, ctype, category, toplist, template_search_list):
+        key = (self.name, ctype and ctype.app_label, ctype and ctype.model,
+               category, tuple(template_search_list))
+        if ctype is not None:
+            template_search_list = template_search_list + [
+                "reviews/%s/%s/toplist.html" % (ctype.app_label, ctype.model),
+                "reviews/%s/toplist.html" % ctype.app_label,
+            ]
+        if category:
+            template_search_list = template_search_list + ["reviews/toplist_%s.html" % category]
+        template_search_list = template_search_list + ["reviews/toplist.html"]
+
+        return render_review_template(context, key, template_search_list, {
+                    "category": category,
+                    "toplist" : toplist,
+                  })
 
 
 @register.simple_tag
@@ -252,11 +540,13 @@ def review_form_target():
     return reviews.get_form_target()
 
 register.tag(GetReviewCount)
+register.tag(GetReviewAverage)
+register.tag(GetReviewStats)
+register.tag(PrefetchReviews)
+register.tag(GetSegmentRatings)
 register.tag(GetReviewList)
 register.tag(RenderReviewList)
 register.tag(GetReviewtForm)
 register.tag(RenderReviewForm)
-
-# TODO
-# get_review_toplist
-# render_review_toplist
\ No newline at end of file
+register.tag(GetReviewToplist)
+register.tag(RenderReviewToplist)
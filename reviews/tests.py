@@ -0,0 +1,332 @@
+"""
+Behavior tests of the review app. They use the models of the REVIEWS_APP and
+the fixtures of the test project, run them with
+
+    cd testapp
+    python manage.py test reviews
+"""
+import datetime
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.template import Context, Template
+from django.test import TestCase
+from reviews import tokens
+from reviews.indexes import INDEXES, get_indexes
+from reviews.export import iter_records
+from reviews.fragments import get_object_version, get_version_key
+from reviews.models import Category, ArchivedReview, ReviewFlag, ReviewSummary, \
+    SegmentSummary, SpooledReview
+from reviews.pagination import ORDERINGS, REVIEWS_PAGE_SIZE, decode_cursor, \
+    encode_cursor, paginate
+from reviews.profanity import get_matcher
+from reviews.signing import BadSignature
+from testdata.models import Car
+import reviews
+
+class ReviewTestCase(TestCase):
+    """
+    Creates reviews of a new car in the "Car" category. The fixture reviews
+    belong to other cars and are left alone by the assertions.
+    """
+
+    def setUp(self):
+        self.car = Car.objects.create(name='Test car')
+        self.category = Category.objects.get(code='Car')
+        self.user = User.objects.create_user('moderator', 'moderator@example.com', 'secret')
+
+    def create_review(self, rating, segments=(), obj=None, **kwargs):
+        obj = obj or self.car
+        data = dict(
+            content_type = ContentType.objects.get_for_model(obj),
+            object_pk    = unicode(obj.pk),
+            site_id      = settings.SITE_ID,
+            category     = self.category,
+            user_name    = 'reviewer',
+            user_email   = 'reviewer@example.com',
+            title        = 'Title',
+            text         = 'Review text %s' % rating,
+            rating       = rating,
+            price        = 100,
+        )
+        data.update(kwargs)
+        review = reviews.get_model()(**data)
+        review.save()
+        for segment, rating in zip(self.category.get_segments(), segments):
+            reviews.get_segment_model()(review=review, segment=segment,
+                                        rating=rating, text='Segment',
+                                        title='Segment').save()
+        return review
+
+    def get_reviews(self):
+        """
+        QuerySet of the reviews the test created.
+        """
+        return reviews.get_model().objects.for_model(self.car)
+
+    def get_summary(self):
+        return ReviewSummary.objects.get_for_object(self.car, 'Car')
+
+class SummaryTest(ReviewTestCase):
+
+    def assertSummary(self, count, rating_sum):
+        summary = self.get_summary()
+        self.assertEqual(summary.review_count, count)
+        self.assertEqual(summary.rating_sum, rating_sum)
+
+    def test_post(self):
+        self.create_review(2, segments=[1, 4])
+        self.create_review(5, segments=[3])
+        summary = self.get_summary()
+        self.assertEqual(summary.review_count, 2)
+        self.assertEqual(summary.rating_sum, 7)
+        self.assertEqual((summary.rating_min, summary.rating_max), (2, 5))
+
+        design, handling = SegmentSummary.objects.get_for_object(self.car, 'Car')
+        self.assertEqual((design.review_count, design.rating_sum), (2, 4))
+        self.assertEqual((design.rating_1, design.rating_3), (1, 1))
+        self.assertEqual((handling.review_count, handling.rating_sum), (1, 4))
+
+    def test_remove_and_approve(self):
+        review = self.create_review(4)
+        self.create_review(2)
+        model = reviews.get_model()
+
+        model.objects.remove(model.objects.filter(pk=review.pk), self.user)
+        self.assertSummary(1, 2)
+        model.objects.approve(model.objects.filter(pk=review.pk), self.user)
+        self.assertSummary(2, 6)
+        self.assertEqual(ReviewFlag.objects.filter(review=review).count(), 2)
+
+    def test_moderation_queue(self):
+        review = self.create_review(3, is_public=False)
+        self.assertSummary(0, 0)
+        model = reviews.get_model()
+        queue = model.objects.in_moderation().filter(pk__in=self.get_reviews())
+        self.assertEqual(list(queue), [review])
+        model.objects.approve(queue, self.user)
+        self.assertSummary(1, 3)
+
+    def test_delete(self):
+        review = self.create_review(4, segments=[5, 5])
+        self.create_review(1)
+        review.delete()
+        self.assertSummary(1, 1)
+        self.assertEqual([s.review_count for s in
+                          SegmentSummary.objects.get_for_object(self.car, 'Car')], [0, 0])
+
+class CursorTest(ReviewTestCase):
+
+    def setUp(self):
+        super(CursorTest, self).setUp()
+        submit_date = datetime.datetime(2011, 5, 14, 9, 30, 12, 5000)
+        # equal dates and ratings, so the ties are broken by the id
+        for i, rating in enumerate([3, 5, 3, 1, 5, 3, 2]):
+            self.create_review(rating, submit_date=submit_date +
+                               datetime.timedelta(minutes=i // 2))
+
+    def test_round_trip(self):
+        for order, ordering in ORDERINGS.items():
+            for review in self.get_reviews():
+                cursor = encode_cursor(review, ordering)
+                self.assertEqual(decode_cursor(cursor, ordering),
+                                 [getattr(review, field.lstrip('-'))
+                                  for field in ordering])
+
+    def test_malformed_cursor(self):
+        ordering = ORDERINGS['highest']
+        self.assertEqual(decode_cursor('20110514093012005000_1', ordering), None)
+        self.assertEqual(decode_cursor('x_20110514093012005000_1', ordering), None)
+
+    def test_pages(self):
+        for order, ordering in ORDERINGS.items():
+            expected = list(self.get_reviews().order_by(*ordering)
+                            .values_list('pk', flat=True))
+            pks = []
+            cursor = None
+            while True:
+                page = paginate(self.get_reviews(), order, limit=2, after=cursor)
+                pks.extend([review.pk for review in page])
+                if not page.has_next():
+                    break
+                cursor = page.next_cursor
+            self.assertEqual(pks, expected, order)
+
+    def test_list_tag_pages_by_default(self):
+        for i in range(REVIEWS_PAGE_SIZE):
+            self.create_review(4)
+        context = Context({'car': self.car})
+        Template('{% load reviewtags %}'
+                 '{% get_review_list for car as review_list %}').render(context)
+        review_list = context['review_list']
+        self.assertEqual(len(review_list), REVIEWS_PAGE_SIZE)
+        self.assertTrue(review_list.has_next())
+
+class TokenTest(TestCase):
+
+    def test_round_trip(self):
+        for value in ('sports-cars', u'\xdcberland', 42, 0):
+            self.assertEqual(tokens.loads(tokens.dumps(value)), value)
+            self.assertEqual(type(tokens.loads(tokens.dumps(value))), type(value))
+
+    def test_tampered(self):
+        token = tokens.dumps('sports-cars')
+        for i in range(len(token) - 1):
+            char = token[i] == 'A' and 'B' or 'A'
+            tampered = token[:i] + char + token[i + 1:]
+            self.assertFalse(tokens.is_signed(tampered))
+            self.assertRaises(BadSignature, tokens.loads, tampered)
+        self.assertRaises(BadSignature, tokens.loads, token[:-2])
+        self.assertRaises(BadSignature, tokens.loads, 'sports-cars')
+
+    def test_salt(self):
+        token = tokens.dumps(5, salt='category')
+        self.assertEqual(tokens.loads(token, salt='category'), 5)
+        self.assertRaises(BadSignature, tokens.loads, token)
+        self.assertRaises(BadSignature, tokens.loads, token, salt='other')
+
+    def test_types(self):
+        self.assertRaises(TypeError, tokens.dumps, True)
+        self.assertRaises(TypeError, tokens.dumps, 1.5)
+
+class SpoolTest(ReviewTestCase):
+
+    def spool(self, key, rating=4):
+        review = reviews.get_model()(
+            content_type    = ContentType.objects.get_for_model(self.car),
+            object_pk       = unicode(self.car.pk),
+            site_id         = settings.SITE_ID,
+            category        = self.category,
+            user_name       = 'reviewer',
+            title           = 'Title',
+            text            = 'Spooled review',
+            rating          = rating,
+            price           = 100,
+            submit_date     = datetime.datetime.now(),
+            idempotency_key = key,
+        )
+        segment = reviews.get_segment_model()(
+            segment = self.category.get_segments()[0],
+            rating  = rating,
+            text    = 'Segment',
+            title   = 'Segment',
+        )
+        return SpooledReview.objects.spool(review, [segment])
+
+    def test_process(self):
+        self.spool('a', 4)
+        self.spool('b', 2)
+        self.assertEqual(SpooledReview.objects.process(), (2, 0, 0))
+        self.assertEqual(SpooledReview.objects.count(), 0)
+        self.assertEqual(self.get_summary().review_count, 2)
+        self.assertEqual(reviews.get_segment_model().objects.filter(
+            review__in=self.get_reviews()).count(), 2)
+        self.assertEqual(SpooledReview.objects.process(), (0, 0, 0))
+
+    def test_duplicate(self):
+        self.spool('a')
+        self.assertEqual(SpooledReview.objects.process(), (1, 0, 0))
+        # the same form posted again after the first submission was saved
+        self.spool('a')
+        self.assertEqual(SpooledReview.objects.process(), (0, 1, 0))
+        self.assertEqual(SpooledReview.objects.count(), 0)
+        self.assertEqual(self.get_summary().review_count, 1)
+
+    def test_duplicate_in_spool(self):
+        self.spool('a')
+        self.assertRaises(IntegrityError, self.spool, 'a')
+
+class VersionTest(ReviewTestCase):
+
+    def test_stored_version(self):
+        ctype = ContentType.objects.get_for_model(self.car)
+        # the car id may have been used by another test
+        cache.delete(get_version_key(ctype.pk, self.car.pk))
+        self.assertEqual(get_object_version(ctype.pk, self.car.pk), '0')
+        review = self.create_review(3)
+        version = get_object_version(ctype.pk, self.car.pk)
+        self.assertNotEqual(version, '0')
+
+        # a restart or an eviction doesn't change the version
+        cache.delete(get_version_key(ctype.pk, self.car.pk))
+        self.assertEqual(get_object_version(ctype.pk, self.car.pk), version)
+
+        reviews.get_model().objects.remove(
+            reviews.get_model().objects.filter(pk=review.pk), self.user)
+        cache.delete(get_version_key(ctype.pk, self.car.pk))
+        self.assertTrue(float(get_object_version(ctype.pk, self.car.pk)) > float(version))
+
+class ArchiveTest(ReviewTestCase):
+
+    def get_records(self):
+        records = list(iter_records(self.get_reviews()))
+        for record in records:
+            record['flags'] = sorted(ReviewFlag.objects.filter(review=record['id'])
+                                     .values_list('user', 'flag'))
+        return records
+
+    def archive(self):
+        archivable = ArchivedReview.objects.get_archivable().filter(
+            pk__in=list(self.get_reviews().values_list('pk', flat=True)))
+        return ArchivedReview.objects.archive(archivable)
+
+    def test_archive_and_restore(self):
+        review = self.create_review(1, segments=[2, 3])
+        self.create_review(4)
+        ReviewFlag.objects.create(review=review, user=self.user,
+                                  flag=ReviewFlag.SUGGEST_REMOVAL)
+        reviews.get_model().objects.remove(
+            reviews.get_model().objects.filter(pk=review.pk), self.user)
+        before = self.get_records()
+
+        self.assertEqual(self.archive(), 1)
+        self.assertEqual(self.get_reviews().count(), 1)
+        self.assertEqual(ReviewFlag.objects.filter(review=review.pk).count(), 0)
+        archived = ArchivedReview.objects.filter(review_id=review.pk)
+        self.assertEqual(archived.count(), 1)
+
+        self.assertEqual(ArchivedReview.objects.restore(archived.all()), (1, []))
+        self.assertEqual(archived.count(), 0)
+        self.assertEqual(self.get_records(), before)
+        self.assertEqual(self.get_summary().review_count, 1)
+
+    def test_restore_taken_id(self):
+        review = self.create_review(1, is_removed=True)
+        self.archive()
+        self.create_review(3, id=review.pk)
+
+        archived = ArchivedReview.objects.filter(review_id=review.pk)
+        self.assertEqual(ArchivedReview.objects.restore(archived.all()), (0, [review.pk]))
+        self.assertEqual(archived.count(), 1)
+        self.assertEqual(self.get_reviews().get().rating, 3)
+
+class ObjectIdTest(ReviewTestCase):
+
+    def test_filled_on_save(self):
+        review = self.create_review(3)
+        self.assertEqual(review.object_id, self.car.pk)
+        self.assertEqual(reviews.get_model().objects.get(pk=review.pk).object_id,
+                         self.car.pk)
+        self.assertEqual(list(self.get_reviews()), [review])
+
+class IndexTest(TestCase):
+
+    def test_created_by_syncdb(self):
+        for table, columns in INDEXES:
+            self.assertTrue(columns in get_indexes(table), columns)
+
+class ProfanityTest(TestCase):
+
+    def test_overlapping_words(self):
+        words = ['ab', 'abc', 'bcd', 'ass']
+        self.assertEqual(get_matcher(words).find_all('xABcd class'),
+                         ['ab', 'abc', 'bcd', 'ass'])
+        self.assertEqual(get_matcher(words, True).find_all('abcd class, ab'),
+                         ['ab'])
+
+    def test_cached_per_list(self):
+        words = ['ab']
+        self.assertTrue(get_matcher(words) is get_matcher(words))
+        self.assertEqual(get_matcher(['cd']).find_all('abcd'), ['cd'])
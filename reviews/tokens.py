@@ -0,0 +1,99 @@
+"""
+Compact signed tokens for small values, e.g. the category in the review form.
+
+A token is the url-safe base64 (without padding) of
+
+    <type: 1 byte> <payload> <HMAC-SHA1 of type and payload: 16 bytes>
+
+with the types "s" (byte string), "u" (unicode, utf-8 encoded) and "i"
+(integer, decimal digits). Unlike reviews.signing nothing is pickled, so a
+token can only ever decode to one of these types, and a category code of a
+few characters gives a token of about 30 characters.
+
+is_signed() checks a value without raising exceptions. Verified tokens are
+kept in a small bounded cache, so a token that is rendered and posted again
+is verified only once per process.
+"""
+import base64
+from django.utils.crypto import salted_hmac, constant_time_compare
+from reviews.signing import BadSignature
+
+KEY_SALT = 'reviews.tokens'
+MAC_LENGTH = 16
+
+# the number of verified tokens remembered; the cache is emptied when full
+VERIFY_CACHE_SIZE = 1000
+
+_verified = {}
+_INVALID = object()
+
+def _mac(data, salt):
+    return salted_hmac(KEY_SALT + salt, data).digest()[:MAC_LENGTH]
+
+def dumps(value, salt=''):
+    """
+    Returns the signed token of a string or an integer. ``salt`` separates
+    tokens of different uses, it must be given to loads() again.
+    """
+    if isinstance(value, bool) or not isinstance(value, (basestring, int, long)):
+        raise TypeError("Only strings and integers can be signed, not %r" % type(value))
+    if isinstance(value, unicode):
+        data = 'u' + value.encode('utf-8')
+    elif isinstance(value, str):
+        data = 's' + value
+    else:
+        data = 'i' + str(value)
+    return base64.urlsafe_b64encode(data + _mac(data, salt)).rstrip('=')
+
+def _verify(token, salt):
+    """
+    Returns the value of a token or _INVALID, without raising exceptions.
+    """
+    key = (salt, token)
+    value = _verified.get(key, _INVALID)
+    if value is not _INVALID:
+        return value
+
+    if not isinstance(token, basestring) or len(token) < 23:
+        return _INVALID
+    try:
+        raw = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+    except (TypeError, ValueError, UnicodeError):
+        return _INVALID
+    data, mac = raw[:-MAC_LENGTH], raw[-MAC_LENGTH:]
+    if not data or not constant_time_compare(mac, _mac(data, salt)):
+        return _INVALID
+
+    kind, payload = data[0], data[1:]
+    try:
+        if kind == 'u':
+            value = payload.decode('utf-8')
+        elif kind == 's':
+            value = payload
+        elif kind == 'i':
+            value = int(payload)
+        else:
+            return _INVALID
+    except ValueError:
+        return _INVALID
+
+    if len(_verified) >= VERIFY_CACHE_SIZE:
+        _verified.clear()
+    _verified[key] = value
+    return value
+
+def is_signed(value, salt=''):
+    """
+    Whether ``value`` is a valid token (for ``salt``).
+    """
+    return _verify(value, salt) is not _INVALID
+
+def loads(token, salt=''):
+    """
+    Reverse of dumps(). Raises BadSignature if the token was changed, is
+    malformed or was made with another salt.
+    """
+    value = _verify(token, salt)
+    if value is _INVALID:
+        raise BadSignature("Invalid token %r" % (token,))
+    return value
@@ -3,6 +3,20 @@ from django.conf.urls.defaults import *
 urlpatterns = patterns('reviews.views',
     url(r'^post/$',          'post_review',       name='reviews-post-review'),
     url(r'^posted/$',        'review_done',       name='reviews-review-done'),
+    url(r'^export/$',        'export_reviews',    name='reviews-export'),
+    url(r'^api/(?P<content_type>\w+\.\w+)/summaries/$',
+                             'review_summaries',  name='reviews-api-summaries'),
+    url(r'^api/(?P<content_type>\w+\.\w+)/(?P<object_pk>[^/]+)/$',
+                             'review_list',       name='reviews-api-list'),
+)
+
+urlpatterns += patterns('reviews.views.moderation',
+    url(r'^flag/(\d+)/$',    'flag',             name='reviews-flag'),
+    url(r'^flagged/$',       'flag_done',        name='reviews-flag-done'),
+    url(r'^delete/(\d+)/$',  'delete',           name='reviews-delete'),
+    url(r'^deleted/$',       'delete_done',      name='reviews-delete-done'),
+    url(r'^approve/(\d+)/$', 'approve',          name='reviews-approve'),
+    url(r'^approved/$',      'approve_done',     name='reviews-approve-done'),
 )
 
 urlpatterns += patterns('',
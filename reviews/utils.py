@@ -20,7 +20,7 @@ def confirmation_view(template, doc="Display a confirmation view."):
         review = None
         if 'c' in request.GET:
             try:
-                review = reviews.get_model().objects.get(pk=request.GET['c'])
+                review = reviews.get_model()._default_manager.get(pk=request.GET['c'])
             except (ObjectDoesNotExist, ValueError):
                 pass
         return render_to_response(template,
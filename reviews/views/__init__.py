@@ -0,0 +1,433 @@
+from django import http
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.comments.views.utils import next_redirect
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import models, IntegrityError
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.views.decorators.http import require_POST, require_GET, condition
+from django.views.decorators.csrf import csrf_protect
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.contenttypes.models import ContentType
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from reviews import signals, tokens
+from reviews.forms import CATEGORY_TOKEN_SALT
+from reviews.bulk import save_review
+from reviews.export import get_export_queryset, iter_records, iter_jsonl, iter_csv
+from reviews.fragments import get_object_version, get_object_versions
+from reviews.managers import get_object_reviews
+from reviews.models import Review, SegmentSummary, SpooledReview
+from reviews.pagination import paginate, REVIEWS_PAGE_SIZE
+import datetime
+import reviews
+
+
+
+# save posted reviews through the spool, see SpooledReview
+REVIEWS_SPOOL = getattr(settings, 'REVIEWS_SPOOL', False)
+
+class ReviewPostBadRequest(http.HttpResponseBadRequest):
+    """
+    Response returned when a review post is invalid. If ``DEBUG`` is on a
+    nice-ish error message will be displayed (for debugging purposes), but in
+    production mode a simple opaque 400 page will be displayed.
+    """
+    def __init__(self, why):
+        super(ReviewPostBadRequest, self).__init__()
+        if settings.DEBUG:
+            self.content = render_to_string("reviews/400-debug.html", {"why": why})
+
+@csrf_protect
+@require_POST
+def post_review(request, next=None, using=None):
+    """
+    Post a review.
+
+    HTTP POST is required. If ``POST['submit'] == "preview"`` or if there are
+    errors a preview template, ``reviews/preview.html``, will be rendered.
+    """
+    # Fill out some initial data fields from an authenticated user, if present
+    data = request.POST.copy()
+    if request.user.is_authenticated():
+        if not data.get('name', ''):
+            data["name"] = request.user.get_full_name() or request.user.username
+        if not data.get('email', ''):
+            data["email"] = request.user.email
+
+    # Check to see if the POST data overrides the view's next argument.
+    next = data.get("next", next)
+
+    # Look up the object we're trying to review about
+    ctype = data.get("content_type")
+    object_pk = data.get("object_pk")
+    if ctype is None or object_pk is None:
+        return ReviewPostBadRequest("Missing content_type or object_pk field.")
+    try:
+        model = models.get_model(*ctype.split(".", 1))
+        target = model._default_manager.using(using).get(pk=object_pk)
+    except TypeError:
+        return ReviewPostBadRequest(
+            "Invalid content_type value: %r" % escape(ctype))
+    except AttributeError:
+        return ReviewPostBadRequest(
+            "The given content-type %r does not resolve to a valid model." % \
+                escape(ctype))
+    except ObjectDoesNotExist:
+        return ReviewPostBadRequest(
+            "No object matching content-type %r and object PK %r exists." % \
+                (escape(ctype), escape(object_pk)))
+    except (ValueError, ValidationError), e:
+        return ReviewPostBadRequest(
+            "Attempting go get content-type %r and object PK %r exists raised %s" % \
+                (escape(ctype), escape(object_pk), e.__class__.__name__))
+
+    # Do we want to preview the review?
+    preview = "preview" in data
+
+    try:
+        category = tokens.loads(data.get('category', ''), CATEGORY_TOKEN_SALT)
+    except tokens.BadSignature:
+        return ReviewPostBadRequest("The review category failed signature verification.")
+
+    # Construct the review form
+    form = reviews.get_form()(target, data=data, category=category)
+
+    # Check security information
+    if form.security_errors():
+        return ReviewPostBadRequest(
+            "The review form failed security verification: %s" % \
+                escape(str(form.security_errors())))
+
+    # If there are errors or if we requested a preview show the review
+    if form.errors or not form.formset.is_valid() or preview:
+        template_list = [
+            # Now the usual directory based template heirarchy.
+            "reviews/%s/%s/preview.html" % (model._meta.app_label, model._meta.module_name),
+            "reviews/%s/preview.html" % model._meta.app_label,
+
+            # like before, but with optional different template per category
+            "reviews/%s/%s/preview_%s.html" % (model._meta.app_label, model._meta.module_name, category),
+            "reviews/%s/preview_%s.html" % (model._meta.app_label, category),
+            "reviews/preview_%s.html" % category,
+
+            "reviews/preview.html",
+        ]
+        return render_to_response(
+            template_list, {
+                "review" : form.data.get("review", ""),
+                "form" : form,
+                "next": next,
+            },
+            RequestContext(request, {})
+        )
+
+    # Otherwise create the review
+    review = form.get_review_object()
+    if review._get_pk_val() is not None:
+        # the review was posted before, e.g. by a double submit
+        return next_redirect(data, next, 'reviews-review-done', c=review._get_pk_val())
+    review.ip_address = request.META.get("REMOTE_ADDR", None)
+    if request.user.is_authenticated():
+        review.user = request.user
+
+    # get the segments
+    segments = form.get_segment_objects()
+
+    # With the spool, the review is saved later by process_review_spool. Forms
+    # without idempotency key can't be found again on the confirmation page,
+    # their reviews are saved right away.
+    if REVIEWS_SPOOL and review.idempotency_key:
+        try:
+            SpooledReview.objects.spool(review, segments)
+        except IntegrityError:
+            # submitted twice, the first submission is spooled already
+            pass
+        return next_redirect(data, next, 'reviews-review-done', p=review.idempotency_key)
+
+    # Signal that the review is about to be saved
+    responses = signals.review_will_be_posted.send(
+        sender  = review.__class__,
+        review = review,
+        segments = segments,
+        request = request
+    )
+
+    for (receiver, response) in responses:
+        if response == False:
+            return ReviewPostBadRequest(
+                "review_will_be_posted receiver %r killed the review" % receiver.__name__)
+
+    # Save the review with its segments and signal that it was saved. If a
+    # concurrent submission of the same form won, its review is the result.
+    try:
+        save_review(review, segments, using=using)
+    except IntegrityError:
+        try:
+            duplicate = review.__class__._default_manager.using(using).get(
+                idempotency_key=review.idempotency_key)
+        except ObjectDoesNotExist:
+            raise
+        return next_redirect(data, next, 'reviews-review-done', c=duplicate._get_pk_val())
+
+    signals.review_was_posted.send(
+        sender  = review.__class__,
+        review = review,
+        request = request
+    )
+
+    return next_redirect(data, next, 'reviews-review-done', c=review._get_pk_val())
+
+def review_done(request):
+    """
+    Display a "review was posted" success page.
+
+    Templates: `reviews/posted.html``
+    Context:
+        review
+            The posted review, None if it is still pending
+        pending
+            True if the review is still in the spool (see REVIEWS_SPOOL)
+    """
+    model = reviews.get_model()
+    review = None
+    pending = False
+    try:
+        if 'c' in request.GET:
+            review = model._default_manager.get(pk=request.GET['c'])
+        elif request.GET.get('p'):
+            try:
+                review = model._default_manager.get(idempotency_key=request.GET['p'])
+            except ObjectDoesNotExist:
+                pending = SpooledReview.objects.filter(
+                    idempotency_key=request.GET['p']).exists()
+    except (ObjectDoesNotExist, ValueError):
+        pass
+    return render_to_response("reviews/posted.html",
+        {'review': review, 'pending': pending},
+        context_instance=RequestContext(request)
+    )
+
+
+@staff_member_required
+def export_reviews(request):
+    """
+    Streams a review export (see the export_reviews command) to staff users.
+
+    GET parameters: ``format`` ("jsonl" or "csv"), ``content_type``
+    ("app_label.model"), ``category`` (code), ``site`` (id), ``since`` and
+    ``until`` (YYYY-MM-DD).
+
+    The response is generated while it is sent, chunk by chunk. Middleware that
+    reads the whole content (e.g. GZip or ETags) defeats this.
+    """
+    format = request.GET.get('format', 'jsonl')
+    if format not in ('jsonl', 'csv'):
+        return http.HttpResponseBadRequest("Unknown format %r" % escape(format))
+
+    filters = {}
+    for name in ('content_type', 'category', 'site'):
+        filters[name] = request.GET.get(name) or None
+    try:
+        if filters['site']:
+            filters['site'] = int(filters['site'])
+        for name in ('since', 'until'):
+            value = request.GET.get(name)
+            filters[name] = value and datetime.datetime.strptime(value, '%Y-%m-%d') or None
+        qs = get_export_queryset(**filters)
+    except (ValueError, ObjectDoesNotExist), e:
+        return http.HttpResponseBadRequest("Invalid filter: %s" % escape(str(e)))
+
+    records = iter_records(qs)
+    if format == 'csv':
+        response = http.HttpResponse(iter_csv(records, filters['category'] and [filters['category']]),
+                                     mimetype='text/csv')
+    else:
+        response = http.HttpResponse(iter_jsonl(records), mimetype='application/x-json-stream')
+    response['Content-Disposition'] = 'attachment; filename=reviews.%s' % format
+    return response
+
+
+# the largest page (and number of summaries) the JSON API returns
+REVIEWS_API_MAX_LIMIT = getattr(settings, 'REVIEWS_API_MAX_LIMIT', 100)
+
+# how long the summaries of a set of objects are cached; any change of the
+# reviews of one of them invalidates the entry earlier
+REVIEWS_API_CACHE_TIMEOUT = getattr(settings, 'REVIEWS_API_CACHE_TIMEOUT', 10 * 60)
+
+def get_api_content_type(content_type):
+    """
+    Returns the content type of an "app_label.model" string, None if there is
+    none.
+    """
+    try:
+        return ContentType.objects.get_by_natural_key(*content_type.split('.', 1))
+    except (ObjectDoesNotExist, TypeError):
+        return None
+
+def get_review_list_version(request, content_type, object_pk):
+    ctype = get_api_content_type(content_type)
+    if ctype is None:
+        return None
+    return get_object_version(ctype.pk, object_pk)
+
+def review_list_etag(request, content_type, object_pk):
+    """
+    The ETag of a review list: the version of the reviews of the object (see
+    reviews.fragments) and the query string, which selects the page.
+    """
+    version = get_review_list_version(request, content_type, object_pk)
+    if version is None:
+        return None
+    return md5_constructor("%s?%s" % (version, request.GET.urlencode())).hexdigest()
+
+def review_list_last_modified(request, content_type, object_pk):
+    """
+    The version of the reviews of an object is the time of their last change,
+    "0" if it has no reviews.
+    """
+    version = get_review_list_version(request, content_type, object_pk)
+    if version is None or version == '0':
+        return None
+    return datetime.datetime.utcfromtimestamp(int(float(version)))
+
+def serialize_review(review):
+    """
+    Returns the public data of a review (with its segments) as dict for the
+    JSON API.
+    """
+    return {
+        'id'          : review.pk,
+        'name'        : review.userinfo['name'],
+        'title'       : review.title,
+        'text'        : review.text,
+        'rating'      : review.rating,
+        'category'    : review.category.code,
+        'submit_date' : review.submit_date.isoformat(),
+        'segments'    : [{
+                'segment' : segment.segment.title,
+                'rating'  : segment.rating,
+                'text'    : segment.text,
+            } for segment in review.get_segments()],
+    }
+
+def json_response(data):
+    return http.HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+@require_GET
+@condition(etag_func=review_list_etag, last_modified_func=review_list_last_modified)
+def review_list(request, content_type, object_pk):
+    """
+    Returns a page of the reviews of an object as JSON.
+
+    GET parameters: ``category`` (code), ``order`` ("newest", "oldest",
+    "highest" or "lowest"), ``limit`` and ``after`` (the next_cursor of the
+    previous page), see the render_review_list tag.
+
+    The ETag and Last-Modified headers are derived from the version of the
+    reviews of the object, so conditional requests are answered with 304
+    without touching the database.
+    """
+    ctype = get_api_content_type(content_type)
+    if ctype is None or ctype.model_class() is None:
+        raise http.Http404("Unknown content type %r" % content_type)
+
+    category = request.GET.get('category') or None
+    qs = get_object_reviews(reviews.get_model(), ctype.model_class(), object_pk)
+    if category:
+        qs = qs.filter(category__code=category)
+    try:
+        limit = min(int(request.GET.get('limit') or REVIEWS_PAGE_SIZE), REVIEWS_API_MAX_LIMIT)
+    except ValueError:
+        return http.HttpResponseBadRequest("Invalid limit")
+    page = paginate(qs, request.GET.get('order'), max(limit, 1), request.GET.get('after'))
+
+    return json_response({
+        'content_type' : content_type,
+        'object_pk'    : object_pk,
+        'category'     : category,
+        'order'        : page.order,
+        'reviews'      : [serialize_review(review) for review in page],
+        'next_cursor'  : page.next_cursor,
+    })
+
+def get_summary_pks(request):
+    """
+    The sorted, distinct object pks of a summary request, given as
+    ``pks=1,2,3`` and/or ``pk=1&pk=2``.
+    """
+    pks = request.GET.getlist('pk')
+    for value in request.GET.getlist('pks'):
+        pks.extend(value.split(','))
+    return sorted(set([pk.strip() for pk in pks if pk.strip()]))
+
+def get_summaries_key(request, content_type):
+    """
+    The cache key (and ETag) of a summary request: the content type, the
+    sorted key set, the category and the versions of all objects.
+    """
+    if not hasattr(request, '_reviews_summaries_key'):
+        key = None
+        ctype = get_api_content_type(content_type)
+        pks = get_summary_pks(request)
+        if ctype is not None and 0 < len(pks) <= REVIEWS_API_MAX_LIMIT:
+            versions = get_object_versions(ctype.pk, pks)
+            key = md5_constructor(repr((ctype.pk, pks, request.GET.get('category'),
+                                        settings.SITE_ID, versions))).hexdigest()
+        request._reviews_summaries_key = key
+    return request._reviews_summaries_key
+
+def review_summaries_etag(request, content_type):
+    return get_summaries_key(request, content_type)
+
+@require_GET
+@condition(etag_func=review_summaries_etag)
+def review_summaries(request, content_type):
+    """
+    Returns the review count, average rating and per segment averages of many
+    objects of one content type as JSON, by object pk.
+
+    GET parameters: ``pks`` (comma separated) or ``pk`` (repeated), at most
+    REVIEWS_API_MAX_LIMIT, and ``category`` (code).
+
+    The summaries are read with one query for the reviews and one for the
+    segments, and cached per sorted key set until a review of one of the
+    objects changes.
+    """
+    ctype = get_api_content_type(content_type)
+    if ctype is None:
+        raise http.Http404("Unknown content type %r" % content_type)
+    pks = get_summary_pks(request)
+    if not pks or len(pks) > REVIEWS_API_MAX_LIMIT:
+        return http.HttpResponseBadRequest("Give 1 to %d object pks" % REVIEWS_API_MAX_LIMIT)
+
+    cache_key = 'reviews.api.summaries.%s' % get_summaries_key(request, content_type)
+    data = cache.get(cache_key)
+    if data is None:
+        category = request.GET.get('category') or None
+        model = reviews.get_model()
+        if issubclass(model, Review):
+            manager = Review.objects
+        else:
+            manager = model._default_manager
+        summaries = manager.get_stats_for_pks(ctype, pks, category)
+        segments = SegmentSummary.objects.get_for_pks(ctype, pks, category)
+
+        data = {
+            'content_type' : content_type,
+            'category'     : category,
+            'summaries'    : dict([(pk, {
+                    'review_count'   : summaries[pk].review_count,
+                    'rating_average' : summaries[pk].rating_average,
+                    'segments'       : [{
+                            'segment'        : segment.segment.title,
+                            'review_count'   : segment.review_count,
+                            'rating_average' : segment.rating_average,
+                        } for segment in segments[pk]],
+                }) for pk in pks]),
+        }
+        cache.set(cache_key, data, REVIEWS_API_CACHE_TIMEOUT)
+    return json_response(data)
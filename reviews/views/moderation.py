@@ -0,0 +1,160 @@
+from django.conf import settings
+from django.contrib.auth.decorators import login_required, permission_required
+from django.contrib.comments.views.utils import next_redirect
+from django.shortcuts import get_object_or_404, render_to_response
+from django.template import RequestContext
+from django.views.decorators.csrf import csrf_protect
+from reviews import signals
+from reviews.models import ReviewFlag
+from reviews.utils import confirmation_view
+import reviews
+
+@csrf_protect
+@login_required
+def flag(request, review_id, next=None):
+    """
+    Flags a review. Confirmation on GET, action on POST.
+
+    Templates: `reviews/flag.html`,
+    Context:
+        review
+            the flagged `reviews.review` object
+    """
+    review = get_object_or_404(reviews.get_model(), pk=review_id, site__pk=settings.SITE_ID)
+
+    # Flag on POST
+    if request.method == 'POST':
+        perform_flag(request, review)
+        return next_redirect(request.POST.copy(), next, 'reviews-flag-done', c=review.pk)
+
+    # Render a form on GET
+    else:
+        return render_to_response('reviews/flag.html',
+            {'review': review, "next": next},
+            RequestContext(request)
+        )
+
+@csrf_protect
+@permission_required("reviews.can_moderate")
+def delete(request, review_id, next=None):
+    """
+    Deletes a review. Confirmation on GET, action on POST. Requires the "can
+    moderate reviews" permission.
+
+    Templates: `reviews/delete.html`,
+    Context:
+        review
+            the flagged `reviews.review` object
+    """
+    review = get_object_or_404(reviews.get_model(), pk=review_id, site__pk=settings.SITE_ID)
+
+    # Delete on POST
+    if request.method == 'POST':
+        # Flag the review as deleted instead of actually deleting it.
+        perform_delete(request, review)
+        return next_redirect(request.POST.copy(), next, 'reviews-delete-done', c=review.pk)
+
+    # Render a form on GET
+    else:
+        return render_to_response('reviews/delete.html',
+            {'review': review, "next": next},
+            RequestContext(request)
+        )
+
+@csrf_protect
+@permission_required("reviews.can_moderate")
+def approve(request, review_id, next=None):
+    """
+    Approve a review (that is, mark it as public and non-removed). Confirmation
+    on GET, action on POST. Requires the "can moderate reviews" permission.
+
+    Templates: `reviews/approve.html`,
+    Context:
+        review
+            the `reviews.review` object for approval
+    """
+    review = get_object_or_404(reviews.get_model(), pk=review_id, site__pk=settings.SITE_ID)
+
+    # Approve on POST
+    if request.method == 'POST':
+        # Flag the review as approved.
+        perform_approve(request, review)
+        return next_redirect(request.POST.copy(), next, 'reviews-approve-done', c=review.pk)
+
+    # Render a form on GET
+    else:
+        return render_to_response('reviews/approve.html',
+            {'review': review, "next": next},
+            RequestContext(request)
+        )
+
+# The following functions actually perform the various flag/approve/delete
+# actions. They've been broken out into separate functions so that they
+# may be called from admin actions. Moderating many reviews at once is done
+# with Review.objects.approve() and remove() instead.
+
+def perform_flag(request, review):
+    """
+    Actually perform the flagging of a review from a request.
+    """
+    flag, created = ReviewFlag.objects.get_or_create(
+        review = review,
+        user   = request.user,
+        flag   = ReviewFlag.SUGGEST_REMOVAL
+    )
+    signals.review_was_flagged.send(
+        sender  = review.__class__,
+        review  = review,
+        flag    = flag,
+        created = created,
+        request = request,
+    )
+
+def perform_delete(request, review):
+    flag, created = ReviewFlag.objects.get_or_create(
+        review = review,
+        user   = request.user,
+        flag   = ReviewFlag.MODERATOR_DELETION
+    )
+    review.is_removed = True
+    review.save()
+    signals.review_was_flagged.send(
+        sender  = review.__class__,
+        review  = review,
+        flag    = flag,
+        created = created,
+        request = request,
+    )
+
+def perform_approve(request, review):
+    flag, created = ReviewFlag.objects.get_or_create(
+        review = review,
+        user   = request.user,
+        flag   = ReviewFlag.MODERATOR_APPROVAL,
+    )
+
+    review.is_removed = False
+    review.is_public = True
+    review.removal_suggestions = 0
+    review.save()
+
+    signals.review_was_flagged.send(
+        sender  = review.__class__,
+        review  = review,
+        flag    = flag,
+        created = created,
+        request = request,
+    )
+
+flag_done = confirmation_view(
+    template = "reviews/flagged.html",
+    doc = 'Displays a "review was flagged" success page.'
+)
+delete_done = confirmation_view(
+    template = "reviews/deleted.html",
+    doc = 'Displays a "review was deleted" success page.'
+)
+approve_done = confirmation_view(
+    template = "reviews/approved.html",
+    doc = 'Displays a "review was approved" success page.'
+)
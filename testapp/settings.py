@@ -136,6 +136,9 @@ INSTALLED_APPS = (
 
 REVIEWS_APP = 'testdata'
 
+# the tests create the tables with syncdb instead of running the migrations
+SOUTH_TESTS_MIGRATE = False
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error.
@@ -40,7 +40,7 @@ class TestReviewForm(ReviewForm):
             title        = self.cleaned_data["title"],
             rating       = self.cleaned_data["rating"],
             price        = self.cleaned_data["price"],
-            category     = Category.objects.get(code=self.cleaned_data["category"]),
+            category     = Category.objects.get_by_code(self.cleaned_data["category"]),
             submit_date  = datetime.datetime.now(),
             site_id      = settings.SITE_ID,
             is_public    = True,
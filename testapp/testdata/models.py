@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.db import models
+from reviews.managers import ReviewManager
 from reviews.models import Review, ReviewSegment
 
 """
@@ -15,6 +16,9 @@ This all works only if the REVIEW_APP value in settings.py is set to this app.
 class TestReview(Review):
     price = models.IntegerField()
 
+    # managers of Review are not inherited, but used by the template tags
+    objects = ReviewManager()
+
 class TestReviewSegment(ReviewSegment):
     title = models.CharField(max_length=200)
 